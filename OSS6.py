@@ -1,15 +1,305 @@
-from flask import Flask, render_template, request, redirect, url_for
+import time
+_import_started = time.perf_counter()
 import sqlite3
 import os
-import time
-
-app = Flask(__name__)
+import sys
+import argparse
+import contextlib
+import shlex
+import csv
+import json
+import base64
+import hashlib
+import hmac
+import secrets
+import stat
+import tempfile
+import re
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import parse_qsl, quote
 
 # Database setup
 DATABASE = "online_shopping.db"
+
+# Connection management
+# Each thread keeps one long-lived connection; sqlite3 caches the prepared
+# statements per connection, so repeated queries skip the parse step.
+CACHED_STATEMENTS = 256
+BUSY_TIMEOUT = 5.0
+PRAGMAS = {
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # negative means KiB, so roughly 64 MB
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+}
+
+_local = threading.local()
+
+def get_connection():
+    connection = getattr(_local, "connection", None)
+    if connection is not None and _local.database == DATABASE and _local.pid == os.getpid():
+        if _local.instrumented == QUERY_STATS or connection.in_transaction:
+            return connection
+    if connection is not None and _local.pid != os.getpid():
+        # Inherited across a fork (pre-forking WSGI servers); never reuse it
+        _local.connection = None
+    close_connection()
+    connection = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS,
+                                 factory=InstrumentedConnection if QUERY_STATS else sqlite3.Connection)
+    for name, value in PRAGMAS.items():
+        connection.execute(f"PRAGMA {name}={value}")
+    _local.connection = connection
+    _local.database = DATABASE
+    _local.pid = os.getpid()
+    _local.instrumented = QUERY_STATS
+    return connection
+
+def close_connection():
+    connection = getattr(_local, "connection", None)
+    if connection is not None:
+        connection.close()
+        _local.connection = None
+    close_shard_connections()
+    report_connection = getattr(_local, "report_connection", None)
+    if report_connection is not None:
+        report_connection.close()
+        _local.report_connection = None
+        _local.report_identity = None
+
+# Query instrumentation
+# With QUERY_STATS on, connections are opened with cursors that time every
+# statement from execute until its rows have been read, and add the call,
+# bind count, rows and seconds to per (statement, calling function) counters.
+# Statements slower than SLOW_QUERY_SECONDS go to the slow-query log, with
+# their query plan when SLOW_QUERY_EXPLAIN is on. With it off connections are
+# plain sqlite3 ones, so the only cost is a flag check in get_connection.
+# Toggle it with set_query_stats(); each thread reopens its connection the
+# next time it asks for one outside a transaction.
+QUERY_STATS = False
+SLOW_QUERY_SECONDS = 0.1
+SLOW_QUERY_EXPLAIN = False
+SLOW_QUERY_LOG_SIZE = 200
+SLOW_QUERY_LOG_FILE = None  # also append slow queries here as JSON lines
+
+_query_stats = {}  # (statement, caller) -> [calls, binds, rows, seconds, max_seconds, errors]
+_slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_slow_query_count = 0
+_statement_text = {}
+_query_stats_lock = threading.Lock()
+
+def set_query_stats(enabled):
+    global QUERY_STATS
+    QUERY_STATS = bool(enabled)
+
+def reset_query_stats():
+    global _slow_query_count
+    with _query_stats_lock:
+        _query_stats.clear()
+        _slow_queries.clear()
+        _slow_query_count = 0
+
+def statement_text(sql):
+    # SQL with its whitespace collapsed, memoized since statements repeat
+    text = _statement_text.get(sql)
+    if text is None:
+        if len(_statement_text) > 4096:
+            _statement_text.clear()
+        text = _statement_text[sql] = ' '.join(sql.split())
+    return text
+
+def query_caller():
+    # Name of the first function outside the instrumentation
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code in _INSTRUMENTATION_CODE:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return getattr(frame.f_code, "co_qualname", frame.f_code.co_name)
+
+def record_query(sql, caller, binds, rows, seconds, parameters=None, connection=None, error=False):
+    global _slow_query_count
+    statement = statement_text(sql)
+    with _query_stats_lock:
+        entry = _query_stats.get((statement, caller))
+        if entry is None:
+            entry = _query_stats[(statement, caller)] = [0, 0, 0, 0.0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += binds
+        entry[2] += rows
+        entry[3] += seconds
+        entry[4] = max(entry[4], seconds)
+        entry[5] += error
+        if seconds < SLOW_QUERY_SECONDS:
+            return
+        _slow_query_count += 1
+    slow = {"time": time.time(), "statement": statement, "caller": caller, "seconds": seconds,
+            "binds": binds, "rows": rows, "error": error}
+    if SLOW_QUERY_EXPLAIN and connection is not None and parameters is not None:
+        try:
+            # A base sqlite3 cursor, so the plan query is not recorded itself
+            plan = sqlite3.Cursor(connection).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+            slow["plan"] = [row[-1] for row in plan]
+        except sqlite3.Error:
+            pass
+    with _query_stats_lock:
+        _slow_queries.append(slow)
+    if SLOW_QUERY_LOG_FILE:
+        with open(SLOW_QUERY_LOG_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(slow) + '\n')
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # self.query is [sql, caller, binds, parameters, seconds, rows, returns_rows]
+    # for the statement whose rows are still being read
+    query = None
+
+    def execute(self, sql, parameters=()):
+        self.finish_query()
+        caller = query_caller()
+        started = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        except sqlite3.Error:
+            record_query(sql, caller, len(parameters), 0, time.perf_counter() - started, error=True)
+            raise
+        self.query = [sql, caller, len(parameters), parameters, time.perf_counter() - started, 0, self.description is not None]
+        if self.description is None:
+            self.finish_query()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish_query()
+        caller = query_caller()
+        binds = sum(map(len, seq_of_parameters)) if isinstance(seq_of_parameters, (list, tuple)) else 0
+        started = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        except sqlite3.Error:
+            record_query(sql, caller, binds, 0, time.perf_counter() - started, error=True)
+            raise
+        record_query(sql, caller, binds, max(self.rowcount, 0), time.perf_counter() - started)
+        return self
+
+    def count_rows(self, started, rows, done):
+        if self.query is not None:
+            self.query[4] += time.perf_counter() - started
+            self.query[5] += rows
+            if done:
+                self.finish_query()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self.count_rows(started, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self.count_rows(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self.count_rows(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.count_rows(started, 0, True)
+            raise
+        self.count_rows(started, 1, False)
+        return row
+
+    def finish_query(self):
+        query = self.query
+        if query is not None:
+            self.query = None
+            sql, caller, binds, parameters, seconds, rows, returns_rows = query
+            record_query(sql, caller, binds, rows if returns_rows else max(self.rowcount, 0), seconds, parameters, self.connection)
+
+    def close(self):
+        self.finish_query()
+        super().close()
+
+    def __del__(self):
+        try:
+            self.finish_query()
+        except Exception:
+            pass
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+_INSTRUMENTATION_CODE = {
+    function.__code__ for function in (
+        query_caller, InstrumentedCursor.execute, InstrumentedCursor.executemany,
+        InstrumentedConnection.execute, InstrumentedConnection.executemany,
+    )
+}
+
+def query_stats(limit=None):
+    # Per statement and caller, most total time first
+    with _query_stats_lock:
+        items = sorted(_query_stats.items(), key=lambda item: item[1][3], reverse=True)
+        slow = list(_slow_queries)
+        slow_count = _slow_query_count
+    queries = [{"statement": statement, "caller": caller, "calls": calls, "binds": binds, "rows": rows,
+                "seconds": seconds, "max_seconds": max_seconds, "errors": errors}
+               for (statement, caller), (calls, binds, rows, seconds, max_seconds, errors) in items[:limit]]
+    return {"enabled": QUERY_STATS, "slow_query_seconds": SLOW_QUERY_SECONDS, "slow_queries_total": slow_count,
+            "queries": queries, "slow_queries": slow}
+
+QUERY_METRICS = [
+    # (metric name, type, help, position in the counters)
+    ("shop_query_calls_total", "counter", "Statements executed", 0),
+    ("shop_query_binds_total", "counter", "Parameters bound", 1),
+    ("shop_query_rows_total", "counter", "Rows returned or changed", 2),
+    ("shop_query_seconds_total", "counter", "Time spent executing and reading rows", 3),
+    ("shop_query_max_seconds", "gauge", "Slowest single execution", 4),
+    ("shop_query_errors_total", "counter", "Statements that raised sqlite3.Error", 5),
+]
+
+def metric_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def query_metrics_text():
+    # Prometheus text exposition of the query counters
+    with _query_stats_lock:
+        items = list(_query_stats.items())
+        slow_count = _slow_query_count
+    lines = []
+    for name, kind, description, position in QUERY_METRICS:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (statement, caller), counters in items:
+            lines.append(f'{name}{{caller="{metric_label(caller)}",statement="{metric_label(statement)}"}} {counters[position]}')
+    lines.append("# HELP shop_slow_queries_total Statements slower than the slow-query threshold")
+    lines.append("# TYPE shop_slow_queries_total counter")
+    lines.append(f"shop_slow_queries_total {slow_count}")
+    return '\n'.join(lines) + '\n'
+
 def create_tables():
-    with sqlite3.connect(DATABASE) as connection:
+    with get_connection() as connection:
         cursor = connection.cursor()
+
+        # WAL is stored in the database file, so it only has to be set once
+        cursor.execute("PRAGMA journal_mode=WAL")
         
         # Recreate the 'users' table with the new schema
         cursor.execute('''
@@ -96,12 +386,468 @@ def create_tables():
               )
                ''')
 
+        # Transaction Receipts and Order Items (schema versions before 5)
+        # Only the migrations that turn them into orders/order_items need them.
+        if get_schema_version(cursor) < 5:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS transaction_receipts (
+                    receipt_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tracking_id INTEGER,
+                    user_id INTEGER,
+                    courier_info TEXT,
+                    shipping_address TEXT,
+                    payment_receipt TEXT,
+                    total_cost REAL,
+                    created_at REAL,
+                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                )
+            ''')
+
+            # Order Items (one row per product in a receipt)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS order_items (
+                    order_id INTEGER,
+                    product_id INTEGER,
+                    quantity INTEGER,
+                    price REAL,
+                    FOREIGN KEY (order_id) REFERENCES transaction_receipts(receipt_id),
+                    FOREIGN KEY (product_id) REFERENCES products(product_id)
+                )
+            ''')
 
+        apply_migrations(cursor)
+        cursor.execute(f"PRAGMA application_id={SCHEMA_FINGERPRINT}")
 
         connection.commit()
+
+# Recomputes the materialized stock_quantity of every product stocked per warehouse
+SYNC_STOCK_TOTALS = '''
+    UPDATE products SET stock_quantity = (SELECT SUM(quantity) FROM stock WHERE stock.product_id = products.product_id)
+    WHERE product_id IN (SELECT product_id FROM stock)
+'''
+
+# A product's single stock counter moves into DEFAULT_WAREHOUSE when it first
+# gains stock rows, so the totals above never drop stock it already had.
+# STOCK_COUNTERS_TO_WAREHOUSE does that for products with rows whose counter
+# was not derived from them yet; the caller adds any further condition.
+DEFAULT_WAREHOUSE = 0
+STOCK_COUNTERS_TO_WAREHOUSE = f'''
+    INSERT INTO stock (product_id, warehouse_id, quantity)
+    SELECT product_id, {DEFAULT_WAREHOUSE}, stock_quantity FROM products
+    WHERE stock_quantity > 0 AND product_id IN (SELECT product_id FROM stock) {{condition}}
+    ON CONFLICT (product_id, warehouse_id) DO UPDATE SET quantity = quantity + excluded.quantity
+'''
+
+# Price buckets of product_search: bucket N holds prices from bound N-1 (or 0)
+# up to, not including, bound N; the last bucket is everything above
+PRICE_BUCKET_BOUNDS = (10, 25, 50, 100, 250, 500, 1000)
+PRICE_BUCKET_SQL = ('CASE WHEN products.price IS NULL THEN NULL '
+                    + ' '.join(f'WHEN products.price < {bound} THEN {number}' for number, bound in enumerate(PRICE_BUCKET_BOUNDS))
+                    + f' ELSE {len(PRICE_BUCKET_BOUNDS)} END')
+
+# Writes the product_search rows of the products {condition} selects. It is an
+# UPSERT rather than INSERT OR REPLACE: inside a trigger, OR REPLACE gives way
+# to the conflict handling of the statement that fired it, so a products
+# UPSERT (the bulk importer's) would fail on an existing product_search row.
+PRODUCT_SEARCH_COLUMNS = ('name', 'price', 'price_bucket', 'stock_quantity', 'category_id',
+                          'category_name', 'price_range', 'supplier_id', 'supplier_name')
+PRODUCT_SEARCH_UPSERT = f'''
+    INSERT INTO product_search (product_id, {', '.join(PRODUCT_SEARCH_COLUMNS)})
+    SELECT products.product_id, products.name, products.price, {PRICE_BUCKET_SQL}, products.stock_quantity,
+           products.category_id, categories.category_name, categories.price_range, products.supplier_id, suppliers.supplier_name
+    FROM products
+    LEFT JOIN categories ON products.category_id = categories.category_id
+    LEFT JOIN suppliers ON products.supplier_id = suppliers.supplier_id
+    WHERE {{condition}}
+    ON CONFLICT (product_id) DO UPDATE SET {', '.join(f'{name} = excluded.{name}' for name in PRODUCT_SEARCH_COLUMNS)}
+'''
+REBUILD_PRODUCT_SEARCH = PRODUCT_SEARCH_UPSERT.format(condition='1')
+PRODUCT_SEARCH_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON products BEGIN
+        {PRODUCT_SEARCH_UPSERT.format(condition='products.product_id = new.product_id')};
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS product_search_update AFTER UPDATE OF name, price, category_id, supplier_id ON products BEGIN
+        {PRODUCT_SEARCH_UPSERT.format(condition='products.product_id = new.product_id')};
+    END''',
+]
+
+def rebuild_product_search(cursor):
+    # Regenerates product_search, e.g. after a bulk load ran without its triggers
+    cursor.execute('DELETE FROM product_search')
+    cursor.execute(REBUILD_PRODUCT_SEARCH)
+
+# Schema migrations
+# Entry N brings the database to schema version N; the applied version is
+# stored in PRAGMA user_version so each step only ever runs once.
+SCHEMA_MIGRATIONS = [
+    # 1: indexes for the cart, search join and category filter lookups
+    [
+        'CREATE INDEX IF NOT EXISTS idx_shopping_carts_user ON shopping_carts (user_id, product_id, amount)',
+        'CREATE INDEX IF NOT EXISTS idx_products_category ON products (category_id, price, name, stock_quantity)',
+        'CREATE INDEX IF NOT EXISTS idx_categories_name ON categories (category_name, price_range)',
+        'CREATE INDEX IF NOT EXISTS idx_categories_price_range ON categories (price_range, category_name)',
+    ],
+    # 2: sort orders for the keyset-paginated product listings
+    [
+        'CREATE INDEX IF NOT EXISTS idx_products_price ON products (price)',
+        'CREATE INDEX IF NOT EXISTS idx_products_name ON products (name)',
+    ],
+    # 3: FTS5 index over product names, kept in sync by triggers
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(name, content='products', content_rowid='product_id', prefix='2 3')",
+        '''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name) VALUES (new.product_id, new.name);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.product_id, old.name);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.product_id, old.name);
+            INSERT INTO products_fts (rowid, name) VALUES (new.product_id, new.name);
+        END''',
+        "INSERT INTO products_fts (products_fts) VALUES ('rebuild')",
+    ],
+    # 4: sales rollups maintained by checkout, read by the admin reports
+    [
+        'CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)',
+        '''CREATE TABLE IF NOT EXISTS product_sales (
+            product_id INTEGER PRIMARY KEY,
+            purchase_count INTEGER,
+            quantity INTEGER,
+            revenue REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_product_sales_count ON product_sales (purchase_count DESC, product_id)',
+        '''CREATE TABLE IF NOT EXISTS product_sales_hourly (
+            product_id INTEGER,
+            hour INTEGER,
+            purchase_count INTEGER,
+            quantity INTEGER,
+            revenue REAL,
+            PRIMARY KEY (product_id, hour)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT PRIMARY KEY,
+            orders INTEGER,
+            revenue REAL
+        ) WITHOUT ROWID''',
+        # Receipts written before this migration have no order_items, but their totals count
+        '''INSERT OR IGNORE INTO sales_daily (day, orders, revenue)
+        SELECT date(created_at, 'unixepoch') AS day, COUNT(*), SUM(total_cost)
+        FROM transaction_receipts
+        GROUP BY day''',
+    ],
+    # 5: orders replace transaction_receipts, with one order_items row per product
+    [
+        '''CREATE TABLE IF NOT EXISTS orders (
+            order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tracking_id TEXT NOT NULL UNIQUE,
+            user_id INTEGER,
+            courier_info TEXT,
+            shipping_address TEXT,
+            total_cost REAL,
+            created_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )''',
+        # Old tracking IDs were Unix seconds and may repeat, so the receipt ID is appended
+        '''INSERT INTO orders (order_id, tracking_id, user_id, courier_info, shipping_address, total_cost, created_at)
+        SELECT receipt_id, printf('%s-%d', tracking_id, receipt_id), user_id, courier_info, shipping_address, total_cost, created_at
+        FROM transaction_receipts''',
+        '''CREATE TABLE order_items_new (
+            order_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER,
+            price REAL,
+            PRIMARY KEY (order_id, product_id),
+            FOREIGN KEY (order_id) REFERENCES orders(order_id),
+            FOREIGN KEY (product_id) REFERENCES products(product_id)
+        ) WITHOUT ROWID''',
+        '''INSERT INTO order_items_new (order_id, product_id, quantity, price)
+        SELECT order_id, product_id, SUM(quantity), MAX(price)
+        FROM order_items
+        GROUP BY order_id, product_id''',
+        'DROP TABLE order_items',
+        'ALTER TABLE order_items_new RENAME TO order_items',
+        'DROP TABLE transaction_receipts',
+        'CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id, order_id)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, created_at)',
+    ],
+    # 6: warehouse stock. Once a product has stock rows its stock_quantity is
+    # their materialized total, kept in step by the triggers below.
+    [
+        'CREATE INDEX IF NOT EXISTS idx_stock_allocation ON stock (product_id, quantity DESC, warehouse_id)',
+        STOCK_COUNTERS_TO_WAREHOUSE.format(condition=''),
+        '''CREATE TRIGGER IF NOT EXISTS stock_total_insert AFTER INSERT ON stock BEGIN
+            UPDATE products SET stock_quantity = CASE
+                WHEN EXISTS (SELECT 1 FROM stock WHERE product_id = new.product_id AND warehouse_id != new.warehouse_id)
+                THEN COALESCE(stock_quantity, 0) + COALESCE(new.quantity, 0)
+                ELSE COALESCE(new.quantity, 0) END
+            WHERE product_id = new.product_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stock_total_update AFTER UPDATE OF quantity, product_id ON stock BEGIN
+            UPDATE products SET stock_quantity = COALESCE(stock_quantity, 0) - COALESCE(old.quantity, 0) WHERE product_id = old.product_id;
+            UPDATE products SET stock_quantity = COALESCE(stock_quantity, 0) + COALESCE(new.quantity, 0) WHERE product_id = new.product_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stock_total_delete AFTER DELETE ON stock BEGIN
+            UPDATE products SET stock_quantity = COALESCE(stock_quantity, 0) - COALESCE(old.quantity, 0) WHERE product_id = old.product_id;
+        END''',
+        # Which warehouses a cart line or an order line was filled from
+        '''CREATE TABLE IF NOT EXISTS stock_allocations (
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            warehouse_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (user_id, product_id, warehouse_id)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS order_allocations (
+            order_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            warehouse_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (order_id, product_id, warehouse_id),
+            FOREIGN KEY (order_id) REFERENCES orders(order_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_order_allocations_warehouse ON order_allocations (warehouse_id, product_id)',
+        SYNC_STOCK_TOTALS,
+    ],
+    # 7: product_search, a denormalized projection of products with their
+    # category and supplier names and a precomputed price bucket, kept by the
+    # triggers below. Products also gain a supplier (the "brand" filter).
+    [
+        'ALTER TABLE products ADD COLUMN supplier_id INTEGER REFERENCES suppliers(supplier_id)',
+        '''CREATE TABLE IF NOT EXISTS product_search (
+            product_id INTEGER PRIMARY KEY,
+            name TEXT,
+            price REAL,
+            price_bucket INTEGER,
+            stock_quantity INTEGER,
+            category_id INTEGER,
+            category_name TEXT,
+            price_range TEXT,
+            supplier_id INTEGER,
+            supplier_name TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_product_search_category ON product_search (category_name, price, product_id)',
+        'CREATE INDEX IF NOT EXISTS idx_product_search_price_range ON product_search (price_range, price, product_id)',
+        'CREATE INDEX IF NOT EXISTS idx_product_search_supplier ON product_search (supplier_name, price, product_id)',
+        'CREATE INDEX IF NOT EXISTS idx_product_search_price ON product_search (price, product_id)',
+        'CREATE INDEX IF NOT EXISTS idx_product_search_bucket ON product_search (price_bucket, category_name)',
+        'CREATE INDEX IF NOT EXISTS idx_product_search_category_id ON product_search (category_id)',
+        'CREATE INDEX IF NOT EXISTS idx_product_search_supplier_id ON product_search (supplier_id)',
+        *PRODUCT_SEARCH_TRIGGERS,
+        # Stock moves on every reservation, so it only touches the one column
+        '''CREATE TRIGGER IF NOT EXISTS product_search_stock AFTER UPDATE OF stock_quantity ON products BEGIN
+            UPDATE product_search SET stock_quantity = new.stock_quantity WHERE product_id = new.product_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON products BEGIN
+            DELETE FROM product_search WHERE product_id = old.product_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_search_category_insert AFTER INSERT ON categories BEGIN
+            UPDATE product_search SET category_name = new.category_name, price_range = new.price_range
+            WHERE category_id = new.category_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_search_category_update AFTER UPDATE OF category_name, price_range ON categories BEGIN
+            UPDATE product_search SET category_name = new.category_name, price_range = new.price_range
+            WHERE category_id = new.category_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_search_category_delete AFTER DELETE ON categories BEGIN
+            UPDATE product_search SET category_name = NULL, price_range = NULL WHERE category_id = old.category_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_search_supplier_insert AFTER INSERT ON suppliers BEGIN
+            UPDATE product_search SET supplier_name = new.supplier_name WHERE supplier_id = new.supplier_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_search_supplier_update AFTER UPDATE OF supplier_name ON suppliers BEGIN
+            UPDATE product_search SET supplier_name = new.supplier_name WHERE supplier_id = new.supplier_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS product_search_supplier_delete AFTER DELETE ON suppliers BEGIN
+            UPDATE product_search SET supplier_name = NULL WHERE supplier_id = old.supplier_id;
+        END''',
+        REBUILD_PRODUCT_SEARCH,
+    ],
+    # 8: one cart line per (user, product), with the line's current value in
+    # total_cost, and carts holding each user's maintained item count and total
+    [
+        '''CREATE TABLE shopping_carts_new (
+            cart_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            total_cost REAL NOT NULL DEFAULT 0,
+            product_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            UNIQUE (user_id, product_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (product_id) REFERENCES products(product_id)
+        )''',
+        '''INSERT INTO shopping_carts_new (user_id, product_id, amount, total_cost)
+        SELECT shopping_carts.user_id, shopping_carts.product_id, SUM(shopping_carts.amount),
+               SUM(shopping_carts.amount) * COALESCE(MAX(products.price), 0)
+        FROM shopping_carts
+        LEFT JOIN products ON shopping_carts.product_id = products.product_id
+        WHERE shopping_carts.user_id IS NOT NULL AND shopping_carts.product_id IS NOT NULL AND shopping_carts.amount IS NOT NULL
+        GROUP BY shopping_carts.user_id, shopping_carts.product_id''',
+        'DROP TABLE shopping_carts',
+        'ALTER TABLE shopping_carts_new RENAME TO shopping_carts',
+        'CREATE INDEX IF NOT EXISTS idx_shopping_carts_product ON shopping_carts (product_id)',
+        '''CREATE TABLE IF NOT EXISTS carts (
+            user_id INTEGER PRIMARY KEY,
+            items INTEGER NOT NULL,
+            total_cost REAL NOT NULL
+        )''',
+        '''INSERT INTO carts (user_id, items, total_cost)
+        SELECT user_id, SUM(amount), SUM(total_cost) FROM shopping_carts GROUP BY user_id''',
+        '''CREATE TRIGGER IF NOT EXISTS cart_line_insert AFTER INSERT ON shopping_carts BEGIN
+            INSERT INTO carts (user_id, items, total_cost) VALUES (new.user_id, new.amount, new.total_cost)
+            ON CONFLICT (user_id) DO UPDATE SET items = items + excluded.items, total_cost = total_cost + excluded.total_cost;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS cart_line_update AFTER UPDATE OF amount, total_cost ON shopping_carts BEGIN
+            UPDATE carts SET items = items + new.amount - old.amount, total_cost = total_cost + new.total_cost - old.total_cost
+            WHERE user_id = new.user_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS cart_line_delete AFTER DELETE ON shopping_carts BEGIN
+            UPDATE carts SET items = items - old.amount, total_cost = total_cost - old.total_cost WHERE user_id = old.user_id;
+            DELETE FROM carts WHERE user_id = old.user_id AND items <= 0;
+        END''',
+        # Lines are valued at the current price, so a price change revalues them
+        '''CREATE TRIGGER IF NOT EXISTS cart_line_price AFTER UPDATE OF price ON products BEGIN
+            UPDATE shopping_carts SET total_cost = amount * COALESCE(new.price, 0) WHERE product_id = new.product_id;
+        END''',
+    ],
+    # 9: per-product demand models over the forecast window, and the window
+    # they were fitted on (see fit_demand_models)
+    [
+        '''CREATE TABLE IF NOT EXISTS demand_models (
+            product_id INTEGER PRIMARY KEY,
+            sum_quantity REAL NOT NULL,
+            sum_day_quantity REAL NOT NULL,
+            intercept REAL NOT NULL,
+            slope REAL NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS demand_model_window (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            first_day INTEGER NOT NULL,
+            last_day INTEGER NOT NULL,
+            fitted_at REAL NOT NULL
+        )''',
+    ],
+    # 10: a product's first stock row no longer replaces its single counter;
+    # the counter becomes a DEFAULT_WAREHOUSE row first (stock_total_insert
+    # then adds the new row on top of it)
+    [
+        f'''CREATE TRIGGER IF NOT EXISTS stock_counter_to_warehouse BEFORE INSERT ON stock
+        WHEN NOT EXISTS (SELECT 1 FROM stock WHERE product_id = new.product_id) BEGIN
+            INSERT INTO stock (product_id, warehouse_id, quantity)
+            SELECT product_id, {DEFAULT_WAREHOUSE}, stock_quantity FROM products
+            WHERE product_id = new.product_id AND stock_quantity > 0;
+        END''',
+    ],
+    # 11: login sessions, shared by every process serving the database (see login)
+    [
+        '''CREATE TABLE IF NOT EXISTS sessions (
+            token_hash BLOB PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON sessions (expires_at)',
+    ],
+    # 12: the product_search triggers upsert their row (see PRODUCT_SEARCH_UPSERT)
+    [
+        'DROP TRIGGER IF EXISTS product_search_insert',
+        'DROP TRIGGER IF EXISTS product_search_update',
+        *PRODUCT_SEARCH_TRIGGERS,
+    ],
+]
+
+def get_schema_version(cursor):
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+def apply_migrations(cursor):
+    version = get_schema_version(cursor)
+    for number in range(version, len(SCHEMA_MIGRATIONS)):
+        for statement in SCHEMA_MIGRATIONS[number]:
+            cursor.execute(statement)
+        cursor.execute(f"PRAGMA user_version={number + 1}")
+    return get_schema_version(cursor)
+
+# Startup
+# create_tables stamps the database with the migration count (user_version)
+# and a fingerprint of all the DDL it runs (application_id). ensure_schema
+# reads both with one query and only replays the DDL when either is stale, so
+# a launch against a current database costs one statement. STARTUP records
+# how long the import and the schema check took.
+def schema_fingerprint():
+    # 31 bits of a hash over the DDL of create_tables and the migrations
+    ddl = [value for value in create_tables.__code__.co_consts if isinstance(value, str)]
+    digest = hashlib.blake2b(repr((ddl, SCHEMA_MIGRATIONS)).encode(), digest_size=4).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+SCHEMA_FINGERPRINT = schema_fingerprint()
+STARTUP = {"import_seconds": None, "schema_seconds": None, "schema_updated": None}
+
+def ensure_schema():
+    # Returns True when the DDL had to run
+    started = time.perf_counter()
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT user_version, application_id FROM pragma_user_version, pragma_application_id')
+    updated = cursor.fetchone() != (len(SCHEMA_MIGRATIONS), SCHEMA_FINGERPRINT)
+    if updated:
+        create_tables()
+    STARTUP["schema_seconds"] = time.perf_counter() - started
+    STARTUP["schema_updated"] = updated
+    return updated
+
+# Queries on the hot paths, with sample parameters, that must be index driven
+HOT_QUERIES = {
+    "user_by_username": ('SELECT user_id FROM users WHERE username = ?', ('user',)),
+    "session_by_token": ('SELECT user_id FROM sessions WHERE token_hash = ? AND expires_at > ?', (b'', 0)),
+    "product_by_id": ('SELECT * FROM products WHERE product_id = ?', (1,)),
+    "cart_by_user": ('''
+        SELECT products.product_id, products.name, shopping_carts.amount, products.price
+        FROM shopping_carts
+        JOIN products ON shopping_carts.product_id = products.product_id
+        WHERE shopping_carts.user_id = ?
+    ''', (1,)),
+    "stock_allocation": ('''
+        SELECT warehouse_id, quantity FROM stock
+        WHERE product_id = ? AND quantity > 0
+        ORDER BY quantity DESC, warehouse_id
+    ''', (1,)),
+    "search_by_category": ('''
+        SELECT product_id, name, price, stock_quantity, category_name
+        FROM product_search
+        WHERE category_name = ? AND price BETWEEN ? AND ?
+        ORDER BY price, product_id
+    ''', ('category', 0, 100)),
+    "search_by_price_range": ('''
+        SELECT product_id, name, price, stock_quantity, category_name
+        FROM product_search
+        WHERE price_range = ?
+    ''', ('range',)),
+    "search_by_price": ('''
+        SELECT product_id, name, price, stock_quantity, category_name
+        FROM product_search
+        WHERE price >= ? AND price <= ?
+    ''', (10, 20)),
+}
+
+def check_query_plans(queries=None):
+    # Raises RuntimeError naming every hot query whose plan does a full table scan
+    cursor = get_connection().cursor()
+    failures = []
+    for name, (query, params) in (queries or HOT_QUERIES).items():
+        cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+        for row in cursor.fetchall():
+            detail = row[-1]
+            if detail.startswith('SCAN') and 'INDEX' not in detail:
+                failures.append(f"{name}: {detail}")
+    if failures:
+        # Not an assert, which python -O would strip
+        raise RuntimeError("Queries without an index:\n" + "\n".join(failures))
+    return True
+
 def update_user_info(username, new_full_name, new_email):
     user_id = get_user_id(username)
-    with sqlite3.connect(DATABASE) as connection:
+    with get_connection() as connection:
         cursor = connection.cursor()
 
         cursor.execute('''
@@ -116,7 +862,7 @@ def update_user_info(username, new_full_name, new_email):
 # Add similar functions for managing shipping addresses and changing passwords
 def manage_shipping_addresses(username, new_address):
        user_id = get_user_id(username)
-       with sqlite3.connect(DATABASE) as connection:
+       with get_connection() as connection:
         cursor = connection.cursor()
 
         cursor.execute('''
@@ -130,58 +876,501 @@ def manage_shipping_addresses(username, new_address):
 
 def change_password(username, new_password):
        user_id = get_user_id(username)
-       with sqlite3.connect(DATABASE) as connection:
+       with get_connection() as connection:
         cursor = connection.cursor()
 
         cursor.execute('''
             UPDATE users
             SET password=?
             WHERE user_id=?
-        ''', (new_password, user_id))
+        ''', (hash_password(new_password), user_id))
 
         connection.commit()
+        end_user_sessions(user_id)
         print("Password changed successfully!")
 
 
-def search_products(category=None, price_range=None, brand=None):
-    with sqlite3.connect(DATABASE) as connection:
-        cursor = connection.cursor()
-
-        query = '''
-            SELECT products.product_id, products.name,products.price, products.stock_quantity, categories.category_name
-            FROM products
-            INNER JOIN categories ON products.category_id = categories.category_id
-            WHERE 1=1
-        '''
-
-        params = []
-
-        if category:
-            query += ' AND categories.category_name = ?'
-            params.append(category)
-
-        if price_range:
-            query += ' AND categories.price_range = ?'
-            params.append(price_range)
-
-        if brand:
-            query += ' AND products.brand = ?'
-            params.append(brand)
-
-        cursor.execute(query, params)
-
-        product_data = cursor.fetchall()
-
-        if not product_data:
-            print("No products match the search criteria.")
+# Catalog listing
+# Pages are keyset based: each page continues after the (sort value, product_id)
+# of the previous page's last row, so a deep page costs the same as the first.
+PAGE_SIZE = 100
+PRODUCT_SORTS = {
+    # sort name: (column, position of the column in listing rows)
+    "product_id": ("products.product_id", 0),
+    "name": ("products.name", 1),
+    "price": ("products.price", 2),
+}
+PRODUCT_COLUMNS = 'products.product_id, products.name, products.price, products.stock_quantity'
+
+def fetch_products_page(query, conditions, params, sort="product_id", after=None, page_size=PAGE_SIZE):
+    # Returns (rows, next_key); pass next_key back as `after` for the next page.
+    # next_key is None once the listing is exhausted.
+    if sort not in PRODUCT_SORTS:
+        raise ValueError(f"Unknown sort order: {sort}")
+    column, position = PRODUCT_SORTS[sort]
+    cursor = get_connection().cursor()
+
+    def run(extra, extra_params, order, limit):
+        where = ' AND '.join(list(conditions) + extra) or '1=1'
+        cursor.execute(f'{query} WHERE {where} ORDER BY {order} LIMIT ?', list(params) + extra_params + [limit])
+        return cursor.fetchall()
+
+    if sort == "product_id":
+        extra, extra_params = (['products.product_id > ?'], [after[1]]) if after else ([], [])
+        rows = run(extra, extra_params, 'products.product_id', page_size)
+    else:
+        # NULL sort values order first and never satisfy a row-value comparison,
+        # so they are paged by product_id before the rest of the listing
+        rows = []
+        if after is None or after[0] is None:
+            extra, extra_params = ([f'{column} IS NULL'], [])
+            if after:
+                extra.append('products.product_id > ?')
+                extra_params.append(after[1])
+            rows = run(extra, extra_params, 'products.product_id', page_size)
+            extra, extra_params = ([f'{column} IS NOT NULL'], [])
         else:
+            extra, extra_params = ([f'({column}, products.product_id) > (?, ?)'], list(after))
+        if len(rows) < page_size:
+            rows += run(extra, extra_params, f'{column}, products.product_id', page_size - len(rows))
+
+    next_key = (rows[-1][position], rows[-1][0]) if len(rows) == page_size else None
+    return rows, next_key
+
+def iter_pages(query, conditions, params, sort="product_id", page_size=PAGE_SIZE):
+    after = None
+    while True:
+        rows, after = fetch_products_page(query, conditions, params, sort, after, page_size)
+        yield from rows
+        if after is None:
+            return
+
+def search_conditions(category=None, price_range=None, brand=None, min_price=None, max_price=None, price_bucket=None):
+    # Conditions on product_search, which SEARCH_QUERY reads as "products"
+    conditions = []
+    params = []
+
+    if category:
+        conditions.append('products.category_name = ?')
+        params.append(category)
+
+    if price_range:
+        conditions.append('products.price_range = ?')
+        params.append(price_range)
+
+    if brand:
+        conditions.append('products.supplier_name = ?')
+        params.append(brand)
+
+    if min_price is not None:
+        conditions.append('products.price >= ?')
+        params.append(min_price)
+
+    if max_price is not None:
+        conditions.append('products.price <= ?')
+        params.append(max_price)
+
+    if price_bucket is not None:
+        conditions.append('products.price_bucket = ?')
+        params.append(price_bucket)
+
+    return conditions, params
+
+PRODUCTS_QUERY = f'SELECT {PRODUCT_COLUMNS} FROM products'
+# product_search already carries the category name, so searches need no join
+SEARCH_QUERY = f'SELECT {PRODUCT_COLUMNS}, products.category_name FROM product_search AS products'
+
+def iter_products(sort="product_id", page_size=PAGE_SIZE):
+    # Yields (product_id, name, price, stock_quantity) one page at a time
+    return iter_pages(PRODUCTS_QUERY, [], [], sort, page_size)
+
+def iter_search_products(category=None, price_range=None, brand=None, sort="product_id", page_size=PAGE_SIZE,
+                         min_price=None, max_price=None, price_bucket=None):
+    # Yields (product_id, name, price, stock_quantity, category_name) one page at a time
+    conditions, params = search_conditions(category, price_range, brand, min_price, max_price, price_bucket)
+    return iter_pages(SEARCH_QUERY, conditions, params, sort, page_size)
+
+# Read-through cache
+# Product rows and small search results are served from memory until a
+# mutation of the product (or of a product in a matching category) drops them.
+# Every invalidation also stamps its key or tags with a new generation; a
+# reader takes generation() before its query and passes it to put, which
+# skips the result when a write committed in between could have changed it.
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL = 60.0
+SEARCH_CACHE_MAX_ROWS = 500
+
+class LRUCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current = 0
+        self.key_generations = {}
+        self.tag_generations = {}
+        self.any_tag_generation = 0  # untagged entries depend on every tag
+        self.cleared_generation = 0
+
+    def generation(self):
+        with self.lock:
+            return self.current
+
+    def changed_since(self, generation, key, tags):
+        # Called with the lock held
+        if self.cleared_generation > generation or self.key_generations.get(key, 0) > generation:
+            return True
+        if tags is None:
+            return self.any_tag_generation > generation
+        return any(self.tag_generations.get(tag, 0) > generation for tag in tags)
+
+    def get(self, key):
+        # Returns (found, value)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[1]
+                del self.entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, tags=None, generation=None):
+        # tags=None means the entry depends on every category; generation is
+        # what generation() returned before value was read
+        with self.lock:
+            if generation is not None and self.changed_since(generation, key, tags):
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value, tags)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.current += 1
+            self.key_generations[key] = self.current
+            self.entries.pop(key, None)
+
+    def invalidate_tags(self, tags):
+        # tags=None drops every entry
+        tags = set(tags) if tags is not None else None
+        with self.lock:
+            self.current += 1
+            if tags is None:
+                self.cleared_generation = self.current
+            else:
+                self.any_tag_generation = self.current
+                for tag in tags:
+                    self.tag_generations[tag] = self.current
+            stale = [key for key, entry in self.entries.items() if tags is None or entry[2] is None or entry[2] & tags]
+            for key in stale:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.current += 1
+            self.cleared_generation = self.current
+            # cleared_generation now covers every older stamp
+            self.key_generations.clear()
+            self.tag_generations.clear()
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+product_cache = LRUCache()
+search_cache = LRUCache()
+facet_cache = LRUCache()
+
+def invalidate_product(product_id, category_ids):
+    # Called after a product write commits, with the product's old and new
+    # category, or None when they are unknown
+    product_cache.invalidate(int(product_id))
+    search_cache.invalidate_tags(category_ids)
+    facet_cache.invalidate_tags(category_ids)
+
+def cache_stats():
+    return {"products": product_cache.stats(), "search": search_cache.stats(), "facets": facet_cache.stats()}
+
+def get_product(product_id):
+    # Returns (product_id, name, price, stock_quantity, category_id) or None
+    product_id = int(product_id)
+    found, product = product_cache.get(product_id)
+    if not found:
+        generation = product_cache.generation()
+        cursor = get_connection().cursor()
+        cursor.execute('SELECT product_id, name, price, stock_quantity, category_id FROM products WHERE product_id = ?', (product_id,))
+        product = cursor.fetchone()
+        product_cache.put(product_id, product, generation=generation)
+    return product
+
+def category_tags(category=None, price_range=None):
+    # The category IDs a search is limited to, or None when any product can match
+    if not (category or price_range):
+        return None
+    conditions = []
+    params = []
+    if category:
+        conditions.append('category_name = ?')
+        params.append(category)
+    if price_range:
+        conditions.append('price_range = ?')
+        params.append(price_range)
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT category_id FROM categories WHERE ' + ' AND '.join(conditions), params)
+    return frozenset(row[0] for row in cursor.fetchall())
+
+def cached_search_products(category=None, price_range=None, brand=None, sort="product_id",
+                           min_price=None, max_price=None, price_bucket=None):
+    # Same rows as iter_search_products; result sets up to SEARCH_CACHE_MAX_ROWS
+    # are kept, larger ones stream straight through
+    key = (category or None, price_range or None, brand or None, sort, min_price, max_price, price_bucket)
+    found, rows = search_cache.get(key)
+    if found:
+        yield from rows
+        return
+
+    generation = search_cache.generation()
+    tags = category_tags(category, price_range)
+    rows = []
+    for product in iter_search_products(category, price_range, brand, sort, PAGE_SIZE, min_price, max_price, price_bucket):
+        if rows is not None:
+            rows.append(product)
+            if len(rows) > SEARCH_CACHE_MAX_ROWS:
+                rows = None
+        yield product
+    if rows is not None:
+        search_cache.put(key, rows, tags, generation)
+
+def search_products(category=None, price_range=None, brand=None, sort="product_id"):
+    found = False
+    for product in cached_search_products(category, price_range, brand, sort):
+        if not found:
             print("Product ID | Name | Price | Stock Quantity | Category")
-            for product in product_data:
-                print(f"{product[0]} | {product[2]} | {product[1]} | {product[3]} | {product[4]} |")
+            found = True
+        print(f"{product[0]} | {product[1]} | {product[2]} | {product[3]} | {product[4]} |")
+
+    if not found:
+        print("No products match the search criteria.")
+
+# Facet counts
+# facet_counts returns, for a set of search filters, how many matching products
+# fall under each category, price bucket, supplier and availability, from one
+# GROUP BY over product_search. Results are cached per normalized filter set
+# and dropped like search results when a product in a matching category (or,
+# for filters without a category, any product) changes.
+FACETS = ("category", "price_bucket", "supplier", "availability")
+
+def price_bucket_label(bucket):
+    if bucket is None:
+        return None
+    low = PRICE_BUCKET_BOUNDS[bucket - 1] if bucket > 0 else 0
+    if bucket >= len(PRICE_BUCKET_BOUNDS):
+        return f"{low}+"
+    return f"{low}-{PRICE_BUCKET_BOUNDS[bucket]}"
+
+def facet_counts(category=None, price_range=None, brand=None, min_price=None, max_price=None, price_bucket=None):
+    # Returns {"total": n, "facets": {facet: [(value, count), ...]}}, each
+    # facet's values most frequent first
+    key = (category or None, price_range or None, brand or None, min_price, max_price, price_bucket)
+    found, counts = facet_cache.get(key)
+    if found:
+        return counts
+
+    generation = facet_cache.generation()
+    tags = category_tags(category, price_range)
+    conditions, params = search_conditions(category, price_range, brand, min_price, max_price, price_bucket)
+    cursor = get_connection().cursor()
+    cursor.execute(f'''
+        SELECT category_name, price_bucket, supplier_name, COALESCE(stock_quantity, 0) > 0, COUNT(*)
+        FROM product_search AS products
+        WHERE {' AND '.join(conditions) or '1=1'}
+        GROUP BY 1, 2, 3, 4
+    ''', params)
+    totals = {facet: {} for facet in FACETS}
+    total = 0
+    for category_name, bucket, supplier_name, in_stock, count in cursor.fetchall():
+        total += count
+        for facet, value in zip(FACETS, (category_name, bucket, supplier_name, "in_stock" if in_stock else "out_of_stock")):
+            totals[facet][value] = totals[facet].get(value, 0) + count
+    counts = {"total": total, "facets": {
+        facet: sorted(values.items(), key=lambda item: (-item[1], str(item[0])))
+        for facet, values in totals.items()
+    }}
+    facet_cache.put(key, counts, tags, generation)
+    return counts
+
+# Full-text search
+# products_fts indexes product names through FTS5; triggers from migration 3
+# keep it in step with the products table.
+SEARCH_LIMIT = 20
+
+def fts_match_expression(text):
+    # Every word becomes a quoted prefix term, so "lap pro" matches "Laptop Pro 14"
+    terms = ['"' + word.replace('"', '""') + '"*' for word in text.split()]
+    return ' '.join(terms)
+
+def full_text_search(text, category=None, min_price=None, max_price=None, limit=SEARCH_LIMIT):
+    # Returns (product_id, name, price, stock_quantity, category_name) rows,
+    # best BM25 match first
+    expression = fts_match_expression(text)
+    if not expression:
+        return []
+
+    query = '''
+        SELECT products.product_id, products.name, products.price, products.stock_quantity, products.category_name
+        FROM products_fts
+        JOIN product_search AS products ON products.product_id = products_fts.rowid
+        WHERE products_fts MATCH ?
+    '''
+    params = [expression]
+
+    if category:
+        query += ' AND products.category_name = ?'
+        params.append(category)
+
+    if min_price is not None:
+        query += ' AND products.price >= ?'
+        params.append(min_price)
+
+    if max_price is not None:
+        query += ' AND products.price <= ?'
+        params.append(max_price)
+
+    query += ' ORDER BY bm25(products_fts) LIMIT ?'
+    params.append(limit)
+
+    cursor = get_connection().cursor()
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+# Passwords and sessions
+# Passwords are stored as "scheme$params$salt$hash" so the cost can be tuned
+# (PASSWORD_SCHEME, SCRYPT_N, PBKDF2_ITERATIONS) without breaking old hashes;
+# a login with outdated parameters or a legacy plaintext password rehashes it.
+# A successful login opens a session in the sessions table, so a token works
+# on every worker process; only a hash of the token is stored. Usernames that
+# logged in through this process resolve to their user_id from memory.
+PASSWORD_SCHEME = "scrypt"
+PASSWORD_SCHEMES = ("scrypt", "pbkdf2_sha256")
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 200000
+SESSION_TTL = 3600.0
+
+_user_ids = {}  # username -> user_id
+_user_ids_lock = threading.Lock()
+
+def password_params():
+    if PASSWORD_SCHEME == "scrypt":
+        return f"{SCRYPT_N}:{SCRYPT_R}:{SCRYPT_P}"
+    if PASSWORD_SCHEME == "pbkdf2_sha256":
+        return str(PBKDF2_ITERATIONS)
+    raise ValueError(f"Unknown password scheme: {PASSWORD_SCHEME}")
+
+def derive_key(scheme, params, password, salt):
+    if scheme == "scrypt":
+        n, r, p = (int(value) for value in params.split(':'))
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r)
+    if scheme == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, int(params))
+    raise ValueError(f"Unknown password scheme: {scheme}")
+
+def hash_password(password):
+    params = password_params()
+    salt = os.urandom(16)
+    return f"{PASSWORD_SCHEME}${params}${salt.hex()}${derive_key(PASSWORD_SCHEME, params, password, salt).hex()}"
+
+def verify_password(password, stored):
+    # Returns (matches, needs_rehash)
+    if stored is None or password is None:
+        return False, False
+    parts = stored.split('$')
+    if len(parts) != 4 or parts[0] not in PASSWORD_SCHEMES:
+        # Legacy plaintext password, which may contain '$' itself
+        return hmac.compare_digest(stored.encode(), password.encode()), True
+    scheme, params, salt, expected = parts
+    matches = hmac.compare_digest(derive_key(scheme, params, password, bytes.fromhex(salt)).hex(), expected)
+    return matches, (scheme, params) != (PASSWORD_SCHEME, password_params())
+
+def login(username, password):
+    # Returns a session token, or None when the credentials are wrong
+    verified = verify_login(username, password)
+    if verified is None:
+        return None
+    return open_session(username, *verified)
+
+def verify_login(username, password):
+    # The key derivation half of login, which only reads: returns (user_id,
+    # rehashed password or None), or None when the credentials are wrong
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT user_id, password FROM users WHERE username = ?', (username,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    user_id, stored = row
+    matches, needs_rehash = verify_password(password, stored)
+    if not matches:
+        return None
+    return user_id, hash_password(password) if needs_rehash else None
+
+def open_session(username, user_id, rehashed):
+    # The write half of login; returns the new session token
+    token = secrets.token_urlsafe(32)
+    run_write(write_login, user_id, rehashed, session_key(token), time.time() + SESSION_TTL)
+    with _user_ids_lock:
+        _user_ids[username] = user_id
+    return token
+
+def session_key(token):
+    return hashlib.sha256(token.encode()).digest()
+
+def write_login(cursor, user_id, rehashed, token_hash, expires_at):
+    # Opens the session, rehashing the password when it was outdated; expired
+    # sessions are dropped here, walking idx_sessions_expiry
+    if rehashed is not None:
+        cursor.execute('UPDATE users SET password=? WHERE user_id=?', (rehashed, user_id))
+    cursor.execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),))
+    cursor.execute('INSERT INTO sessions (token_hash, user_id, expires_at) VALUES (?, ?, ?)', (token_hash, user_id, expires_at))
+    return None, []
+
+def session_user(token):
+    # Returns the user_id behind a live session token, or None
+    if not token:
+        return None
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT user_id FROM sessions WHERE token_hash = ? AND expires_at > ?', (session_key(token), time.time()))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def write_end_sessions(cursor, condition, value):
+    cursor.execute(f'DELETE FROM sessions WHERE {condition} = ?', (value,))
+    return None, []
+
+def end_session(token):
+    if token:
+        run_write(write_end_sessions, 'token_hash', session_key(token))
+
+def end_user_sessions(user_id):
+    run_write(write_end_sessions, 'user_id', user_id)
 
 def get_user_id(username):
+    with _user_ids_lock:
+        user_id = _user_ids.get(username)
+    if user_id is not None:
+        return user_id
     try:
-        with sqlite3.connect(DATABASE) as connection:
+        with get_connection() as connection:
             cursor = connection.cursor()
             cursor.execute('SELECT user_id FROM users WHERE username = ?', (username,))
             result = cursor.fetchone()
@@ -195,81 +1384,698 @@ def get_user_id(username):
   
 
 def is_existing_user(username, password):
-    with sqlite3.connect(DATABASE) as connection:
+    return login(username, password) is not None
+
+def create_user(username, password, full_name, email):
+    # Returns the new user_id; raises sqlite3.IntegrityError for a taken username or email
+    with get_connection() as connection:
         cursor = connection.cursor()
-        cursor.execute('SELECT * FROM users WHERE username=? AND password=?', (username, password))
-        res = cursor.fetchone()
-    return res is not None
+        cursor.execute('''
+            INSERT INTO users (username, password, full_name, email)
+            VALUES (?, ?, ?, ?)
+        ''', (username, hash_password(password), full_name, email))
+        return cursor.lastrowid
+
 def register_user(username, password, full_name, email):
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-            cursor.execute('''
-                INSERT INTO users (username, password, full_name, email)
-                VALUES (?, ?, ?, ?)
-            ''', (username, password, full_name, email))
-            connection.commit()
-            print("User registered successfully!")
+        create_user(username, password, full_name, email)
+        print("User registered successfully!")
     except sqlite3.IntegrityError:
         print("Username or email already exists.")
-def add_product(name, price, stock_quantity, category):
+
+# Writes
+# Every catalog and cart mutation is a write_* function that takes a cursor and
+# returns (result, touched), where touched lists the (product_id, category_ids)
+# whose cached reads must go once the write commits. run_write executes one in
+# its own transaction, or hands it to the group-commit queue when
+# WRITE_BATCHING is on.
+WRITE_BATCHING = False
+WRITE_BATCH_SIZE = 64
+WRITE_FLUSH_INTERVAL = 0.005  # seconds a batch waits for more writes
+
+def begin_immediate(connection):
+    # Take the write lock up front so the statements that follow cannot be
+    # interleaved with another writer; commit any implicit transaction first.
+    if connection.in_transaction:
+        connection.commit()
+    connection.execute('BEGIN IMMEDIATE')
+
+def invalidate_touched(touched):
+    for product_id, category_ids in touched:
+        invalidate_product(product_id, category_ids)
+
+def run_write(operation, *args):
+    if WRITE_BATCHING:
+        return get_write_batcher().submit(operation, *args).result()
+    return run_write_on(get_connection(), operation, *args)
+
+def run_write_on(connection, operation, *args):
+    begin_immediate(connection)
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-            cursor.execute('''
-                INSERT INTO products (name, price, stock_quantity, category_id)
-                VALUES (?, ?, ?, ?)
-            ''', (name, price, stock_quantity, category))
+        result, touched = operation(connection.cursor(), *args)
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    invalidate_touched(touched)
+    return result
+
+class WriteBatcher:
+    # Collects writes from any number of threads and commits them together,
+    # every WRITE_FLUSH_INTERVAL seconds or WRITE_BATCH_SIZE writes. Each write
+    # runs in its own savepoint, so a failing write only fails its own future.
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, interval=WRITE_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.connection = None
+        self.thread = threading.Thread(target=self.run, name="shop-group-commit", daemon=True)
+        self.thread.start()
+
+    def submit(self, operation, *args):
+        # The future resolves to the operation's result once its batch is on disk
+        future = Future()
+        self.queue.put((operation, args, future))
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.flush(batch)
+        close_connection()
+
+    def flush(self, batch):
+        connection = get_connection()
+        if connection is not self.connection:
+            # Callers wait for the fsync, so this connection pays for a full
+            # one; batching is what keeps that affordable. Checked per batch
+            # since get_connection may have reopened it.
+            connection.execute('PRAGMA synchronous=FULL')
+            self.connection = connection
+        cursor = connection.cursor()
+        applied = []
+        try:
+            begin_immediate(connection)
+            for operation, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cursor.execute('SAVEPOINT batched_write')
+                try:
+                    result, touched = operation(cursor, *args)
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO batched_write')
+                    cursor.execute('RELEASE batched_write')
+                    future.set_exception(e)
+                    continue
+                cursor.execute('RELEASE batched_write')
+                applied.append((future, result, touched))
             connection.commit()
-            print("Product added successfully!")
+        except Exception as e:
+            if connection.in_transaction:
+                connection.rollback()
+            for operation, args, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            for future, result, touched in applied:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result, touched in applied:
+            invalidate_touched(touched)
+            future.set_result(result)
+
+_write_batcher = None
+_write_batcher_lock = threading.Lock()
+
+def get_write_batcher():
+    global _write_batcher
+    with _write_batcher_lock:
+        if _write_batcher is None:
+            _write_batcher = WriteBatcher()
+        return _write_batcher
+
+def stop_write_batcher():
+    global _write_batcher
+    with _write_batcher_lock:
+        if _write_batcher is not None:
+            _write_batcher.stop()
+            _write_batcher = None
+
+# Sharding
+# With SHARDS above 1, carts and orders live in SHARDS database files chosen by
+# a hash of the user_id: the SHARDED_TABLES below. The catalog, users and
+# stock stay in DATABASE. Each shard connection ATTACHes the catalog read-only.
+# Cart and order queries still join products, but a shard transaction never
+# takes the catalog's write lock, so writes to different shards commit in
+# parallel. Taking stock stays a short catalog transaction; the shard write
+# follows and gives the stock back if it fails (a crash in between loses the
+# reservation's stock, like an abandoned cart). Reports fan out to the
+# shards over a process pool and merge. order_id is only unique within a
+# shard; tracking IDs are unique everywhere.
+SHARDS = 0
+SHARD_DATABASE = None  # a pattern such as "shop.shard{}.db"; defaults to "<database>.shard<N><ext>"
+SHARDED_TABLES = ('shopping_carts', 'carts', 'stock_allocations', 'orders', 'order_items', 'order_allocations',
+                  'product_sales', 'product_sales_hourly', 'sales_daily')
+
+def shard_of(user_id):
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % SHARDS
+
+def shard_path(shard):
+    if SHARD_DATABASE:
+        return SHARD_DATABASE.format(shard)
+    stem, extension = os.path.splitext(DATABASE)
+    return f"{stem}.shard{shard}{extension or '.db'}"
+
+def sqlite_uri(path, mode=None):
+    return f"file:{quote(os.path.abspath(path))}" + (f"?mode={mode}" if mode else "")
+
+def get_shard_connection(shard):
+    # This thread's connection to one shard, with the catalog attached
+    key = (os.getpid(), DATABASE, SHARD_DATABASE, QUERY_STATS)
+    if getattr(_local, "shards_key", None) != key:
+        close_shard_connections()
+        _local.shards_key = key
+    connection = _local.shards.get(shard)
+    if connection is None:
+        connection = sqlite3.connect(sqlite_uri(shard_path(shard)), uri=True, timeout=BUSY_TIMEOUT,
+                                     cached_statements=CACHED_STATEMENTS,
+                                     factory=InstrumentedConnection if QUERY_STATS else sqlite3.Connection)
+        for name, value in PRAGMAS.items():
+            connection.execute(f"PRAGMA {name}={value}")
+        ensure_shard_schema(connection)
+        connection.execute('ATTACH DATABASE ? AS catalog', (sqlite_uri(DATABASE, 'ro'),))
+        _local.shards[shard] = connection
+    return connection
+
+def close_shard_connections():
+    # Connections inherited across a fork are dropped, never closed
+    if getattr(_local, "shards_key", (os.getpid(),))[0] == os.getpid():
+        for connection in getattr(_local, "shards", {}).values():
+            connection.close()
+    _local.shards = {}
+
+def ensure_shard_schema(connection):
+    # Creates the sharded tables, with their indexes and triggers, from the
+    # catalog's own DDL; shards already at the current fingerprint are skipped
+    if connection.execute('PRAGMA application_id').fetchone()[0] == SCHEMA_FINGERPRINT:
+        return
+    ensure_schema()
+    cursor = get_connection().cursor()
+    cursor.execute(f'''
+        SELECT name, sql FROM sqlite_master
+        WHERE tbl_name IN ({", ".join("?" * len(SHARDED_TABLES))}) AND sql IS NOT NULL
+        ORDER BY type != 'table'
+    ''', SHARDED_TABLES)
+    ddl = cursor.fetchall()
+    connection.execute("PRAGMA journal_mode=WAL")
+    begin_immediate(connection)
+    try:
+        existing = {name for name, in connection.execute('SELECT name FROM sqlite_master')}
+        for name, sql in ddl:
+            if name not in existing:
+                connection.execute(sql)
+        connection.execute(f"PRAGMA application_id={SCHEMA_FINGERPRINT}")
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+
+def order_connection(user_id):
+    # The connection holding the user's cart and orders
+    return get_shard_connection(shard_of(user_id)) if SHARDS > 1 else get_connection()
+
+def run_order_write(user_id, operation, *args):
+    # run_write for cart and order data. Sharded writes go straight to the
+    # user's shard; the group-commit queue only serves DATABASE.
+    if SHARDS > 1:
+        return run_write_on(get_shard_connection(shard_of(user_id)), operation, *args)
+    return run_write(operation, *args)
+
+def run_shard_writes(operation, *args):
+    # Runs a write on every shard, each in its own transaction
+    return [run_write_on(get_shard_connection(shard), operation, *args) for shard in range(SHARDS)]
+
+_report_pool = None
+_report_pool_lock = threading.Lock()
+
+def shard_rows(path, query, params):
+    # Runs in a report pool process
+    connection = sqlite3.connect(sqlite_uri(path, 'ro'), uri=True, timeout=BUSY_TIMEOUT)
+    try:
+        return connection.execute(query, params).fetchall()
+    finally:
+        connection.close()
+
+def fan_out(query, params=(), live=False):
+    # Returns one list of rows per database holding orders: every shard's,
+    # read in parallel by the report pool, or the report connection's (the
+    # live database's with live, for readers a stale snapshot would corrupt)
+    global _report_pool
+    if SHARDS <= 1:
+        return [(get_connection() if live else get_report_connection()).execute(query, params).fetchall()]
+    paths = []
+    for shard in range(SHARDS):
+        # Opening it creates a shard nobody has written to yet
+        get_shard_connection(shard)
+        paths.append(shard_path(shard))
+    with _report_pool_lock:
+        if _report_pool is None:
+            # Spawned, not forked: by now this process runs service threads and
+            # holds SQLite connections, and a forked child could inherit a held lock
+            _report_pool = ProcessPoolExecutor(max_workers=min(SHARDS, os.cpu_count() or 1),
+                                               mp_context=multiprocessing.get_context("spawn"))
+    # The pool's processes have no instrumentation, so the whole fan-out is
+    # recorded here as one query of the calling report
+    caller = query_caller() if QUERY_STATS else None
+    started = time.perf_counter()
+    try:
+        results = list(_report_pool.map(shard_rows, paths, [query] * SHARDS, [tuple(params)] * SHARDS))
+    except sqlite3.Error:
+        if caller is not None:
+            record_query(query, caller, len(params), 0, time.perf_counter() - started, error=True)
+        raise
+    if caller is not None:
+        record_query(query, caller, len(params), sum(map(len, results)), time.perf_counter() - started)
+    return results
+
+_INSTRUMENTATION_CODE.add(fan_out.__code__)
+
+def shutdown_report_pool():
+    global _report_pool
+    with _report_pool_lock:
+        if _report_pool is not None:
+            _report_pool.shutdown(wait=True)
+            _report_pool = None
+
+def write_add_product(cursor, name, price, stock_quantity, category):
+    cursor.execute('''
+        INSERT INTO products (name, price, stock_quantity, category_id)
+        VALUES (?, ?, ?, ?)
+    ''', (name, price, stock_quantity, category))
+    return cursor.lastrowid, [(cursor.lastrowid, [category])]
+
+def write_delete_product(cursor, product_id):
+    cursor.execute('DELETE FROM products WHERE product_id=? RETURNING category_id', (product_id,))
+    old_category = [row[0] for row in cursor.fetchall()]
+    return bool(old_category), [(product_id, old_category)]
+
+def write_update_product(cursor, product_id, name, price, stock_quantity, category):
+    cursor.execute('SELECT category_id FROM products WHERE product_id=?', (product_id,))
+    old_category = [row[0] for row in cursor.fetchall()]
+    cursor.execute('''
+        UPDATE products
+        SET name=?, price=?, category_id=?,
+            stock_quantity=CASE WHEN EXISTS (SELECT 1 FROM stock WHERE stock.product_id = products.product_id)
+                                THEN stock_quantity ELSE ? END
+        WHERE product_id=?
+    ''', (name, price, category, stock_quantity, product_id))
+    return cursor.rowcount == 1, [(product_id, old_category + [category])]
+
+def write_update_stock(cursor, product_id, new_stock_quantity):
+    # Products stocked per warehouse are left alone: their total is derived
+    cursor.execute('''
+        UPDATE products SET stock_quantity=?
+        WHERE product_id=? AND NOT EXISTS (SELECT 1 FROM stock WHERE stock.product_id = products.product_id)
+        RETURNING category_id
+    ''', (new_stock_quantity, product_id))
+    category = [row[0] for row in cursor.fetchall()]
+    return bool(category), [(product_id, category)]
+
+def write_assign_category(cursor, product_id, category_id):
+    cursor.execute('SELECT category_id FROM products WHERE product_id=?', (product_id,))
+    old_category = [row[0] for row in cursor.fetchall()]
+    cursor.execute('UPDATE products SET category_id=? WHERE product_id=?', (category_id, product_id))
+    return cursor.rowcount == 1, [(product_id, old_category + [category_id])]
+
+def write_revalue_carts(cursor, product_ids=None):
+    # Revalues the cart lines of product_ids (all of them for None) at the current price
+    condition = "WHERE product_id IN (SELECT value FROM json_each(?))" if product_ids is not None else ""
+    cursor.execute(f'''
+        UPDATE shopping_carts
+        SET total_cost = amount * COALESCE((SELECT price FROM products WHERE products.product_id = shopping_carts.product_id), 0)
+        {condition}
+    ''', (json.dumps(product_ids),) if product_ids is not None else ())
+    return None, []
+
+def revalue_sharded_carts(product_ids=None):
+    # The cart_line_price trigger only reaches carts in DATABASE, so after a
+    # price change the shards' lines are revalued here
+    if SHARDS > 1:
+        run_shard_writes(write_revalue_carts, product_ids)
+
+def add_product(name, price, stock_quantity, category):
+    try:
+        run_write(write_add_product, name, price, stock_quantity, category)
+        print("Product added successfully!")
     except sqlite3.IntegrityError:
         print("Product already exists.")
 
 def delete_product(product_id):
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-            cursor.execute('DELETE FROM products WHERE product_id=?', (product_id,))
-            connection.commit()
-            print("Product deleted successfully!")
+        run_write(write_delete_product, product_id)
+        print("Product deleted successfully!")
     except sqlite3.Error as e:
         print("Error:", e)
 
 def update_product(product_id, name, price, stock_quantity, category):
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-            cursor.execute('''
-                UPDATE products
-                SET name=?, price=?, stock_quantity=?, category_id=?
-                WHERE product_id=?
-            ''', (name,price, stock_quantity, category, product_id))
-            connection.commit()
-            print("Product updated successfully!")
+        run_write(write_update_product, product_id, name, price, stock_quantity, category)
+        revalue_sharded_carts([product_id])
+        print("Product updated successfully!")
     except sqlite3.Error as e:
         print("Error:", e)
 
 def update_stock(product_id, new_stock_quantity):
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-            cursor.execute('UPDATE products SET stock_quantity=? WHERE product_id=?', (new_stock_quantity, product_id))
-            connection.commit()
+        if run_write(write_update_stock, product_id, new_stock_quantity):
             print("Stock quantity updated successfully!")
+        else:
+            print("No such product, or its stock is kept per warehouse.")
     except sqlite3.Error as e:
         print("Error:", e)
 
 def assign_category(product_id, category_id):
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-            cursor.execute('UPDATE products SET category_id=? WHERE product_id=?', (category_id, product_id))
-            connection.commit()
-            print("Category assigned successfully!")
+        run_write(write_assign_category, product_id, category_id)
+        print("Category assigned successfully!")
     except sqlite3.Error as e:
         print("Error:", e)
 
 
+# Warehouse inventory
+# Products with rows in stock are stocked per warehouse and their
+# stock_quantity is the total (see migration 6). take_stock fills a line from
+# the caller's preferred warehouses first -- e.g. nearest first -- and then
+# from the best-stocked ones, walking idx_stock_allocation so only the rows
+# needed are read. Products without stock rows keep a single counter, which
+# becomes their DEFAULT_WAREHOUSE stock once they gain rows (migration 10).
+ALLOCATION_QUERY = '''
+    SELECT warehouse_id, quantity FROM stock
+    WHERE product_id = ? AND quantity > 0
+    ORDER BY quantity DESC, warehouse_id
+'''
+
+def allocate_warehouses(cursor, product_id, quantity, warehouse_order=None):
+    # Returns [(warehouse_id, quantity), ...] covering quantity, or None when short
+    allocations = []
+    remaining = quantity
+    preferred = set()
+    for warehouse_id in warehouse_order or ():
+        preferred.add(warehouse_id)
+        cursor.execute('SELECT quantity FROM stock WHERE product_id = ? AND warehouse_id = ?', (product_id, warehouse_id))
+        row = cursor.fetchone()
+        if row and row[0] and row[0] > 0:
+            taken = min(row[0], remaining)
+            allocations.append((warehouse_id, taken))
+            remaining -= taken
+            if remaining == 0:
+                return allocations
+    rows = cursor.connection.execute(ALLOCATION_QUERY, (product_id,))
+    for warehouse_id, available in rows:
+        if warehouse_id in preferred:
+            continue
+        taken = min(available, remaining)
+        allocations.append((warehouse_id, taken))
+        remaining -= taken
+        if remaining == 0:
+            break
+    rows.close()
+    return allocations if remaining == 0 else None
+
+def take_stock(cursor, product_id, quantity, warehouse_order=None):
+    # Decrements stock for one line inside the caller's transaction. Returns
+    # (price, category_id, allocations), or None when the product is missing or
+    # short; allocations is empty for products without warehouse stock.
+    if quantity <= 0:
+        return None
+    cursor.execute('''
+        SELECT price, category_id, EXISTS (SELECT 1 FROM stock WHERE stock.product_id = products.product_id)
+        FROM products WHERE product_id = ?
+    ''', (product_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    price, category_id, per_warehouse = row
+    if not per_warehouse:
+        # Conditional decrement: no row is touched when stock is short
+        cursor.execute('''
+            UPDATE products SET stock_quantity = stock_quantity - ?
+            WHERE product_id = ? AND stock_quantity >= ?
+        ''', (quantity, product_id, quantity))
+        return (price, category_id, []) if cursor.rowcount == 1 else None
+    allocations = allocate_warehouses(cursor, product_id, quantity, warehouse_order)
+    if allocations is None:
+        return None
+    # The stock triggers bring products.stock_quantity down with these
+    cursor.executemany('UPDATE stock SET quantity = quantity - ? WHERE product_id = ? AND warehouse_id = ?',
+                       [(taken, product_id, warehouse_id) for warehouse_id, taken in allocations])
+    return price, category_id, allocations
+
+def write_adjust_warehouse_stock(cursor, adjustments):
+    # Applies (product_id, warehouse_id, delta) lines, e.g. a receiving or a
+    # stock-take feed. A line that would take a warehouse below zero is skipped
+    # and returned; the rest commit together.
+    failed = []
+    touched = []
+    for product_id, warehouse_id, delta in adjustments:
+        if delta >= 0:
+            cursor.execute('''
+                INSERT INTO stock (product_id, warehouse_id, quantity) VALUES (?, ?, ?)
+                ON CONFLICT (product_id, warehouse_id) DO UPDATE SET quantity = quantity + excluded.quantity
+            ''', (product_id, warehouse_id, delta))
+        else:
+            cursor.execute('''
+                UPDATE stock SET quantity = quantity + ?
+                WHERE product_id = ? AND warehouse_id = ? AND quantity + ? >= 0
+            ''', (delta, product_id, warehouse_id, delta))
+        if cursor.rowcount == 1:
+            touched.append((product_id, None))
+        else:
+            failed.append((product_id, warehouse_id, delta))
+    return failed, touched
+
+def adjust_warehouse_stock(adjustments):
+    # Returns the adjustment lines that were rejected
+    return run_write(write_adjust_warehouse_stock, adjustments)
+
+def warehouse_stock(product_id):
+    # Returns (warehouse_id, quantity) rows, best stocked first
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT warehouse_id, quantity FROM stock WHERE product_id = ? ORDER BY quantity DESC, warehouse_id', (product_id,))
+    return cursor.fetchall()
+
+# Bulk import and export
+# Catalog feeds are streamed in IMPORT_CHUNK_SIZE rows: each chunk is validated,
+# upserted with one executemany and committed, so memory stays flat whatever
+# the file size. Each entity lists its key columns and (column, type, required).
+IMPORT_CHUNK_SIZE = 50000
+MAX_REPORTED_REJECTS = 100
+
+BULK_ENTITIES = {
+    "products": (("product_id",), [("product_id", int, False), ("name", str, True), ("price", float, True),
+                                   ("stock_quantity", int, False), ("category_id", int, False), ("supplier_id", int, False)]),
+    "categories": (("category_id",), [("category_id", int, False), ("category_name", str, True), ("price_range", str, False)]),
+    "suppliers": (("supplier_id",), [("supplier_id", int, False), ("supplier_name", str, True), ("supplier_address", str, False)]),
+    "stock": (("product_id", "warehouse_id"), [("product_id", int, True), ("warehouse_id", int, True), ("quantity", int, True)]),
+}
+
+def bulk_entity(entity):
+    if entity not in BULK_ENTITIES:
+        raise ValueError(f"Unknown entity: {entity}")
+    return BULK_ENTITIES[entity]
+
+def file_format(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in ('csv', 'jsonl'):
+        raise ValueError(f"Unsupported file format: {fmt}")
+    return fmt
+
+def read_records(path, fmt=None):
+    # Yields (line_number, record) pairs; record is None when the line is not valid JSON
+    fmt = file_format(path, fmt)
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield line_number, record if isinstance(record, dict) else None
+
+def validate_record(columns, record):
+    # Returns (row tuple, None) or (None, reason)
+    if record is None:
+        return None, "Malformed record"
+    row = []
+    for name, kind, required in columns:
+        value = record.get(name)
+        if value is None or value == '':
+            if required:
+                return None, f"Missing {name}"
+            row.append(None)
+            continue
+        if kind is int and isinstance(value, float) and not value.is_integer():
+            # int() would quietly truncate a JSONL 3.7 to 3
+            return None, f"Invalid {name}: {value!r}"
+        try:
+            value = kind(value)
+        except (TypeError, ValueError):
+            return None, f"Invalid {name}: {value!r}"
+        if kind is not str and value < 0:
+            return None, f"Negative {name}: {value}"
+        row.append(value)
+    return tuple(row), None
+
+def upsert_statement(entity):
+    keys, columns = bulk_entity(entity)
+    names = [name for name, kind, required in columns]
+    # A feed that leaves out an optional column keeps the stored value
+    updates = ', '.join(f'{name}=excluded.{name}' if required else f'{name}=COALESCE(excluded.{name}, {name})'
+                        for name, kind, required in columns if name not in keys)
+    return f'''
+        INSERT INTO {entity} ({', '.join(names)}) VALUES ({', '.join('?' for name in names)})
+        ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}
+    '''
+
+def import_records(entity, path, fmt=None, rebuild_indexes=False, reject_path=None):
+    # Returns a report with counts, throughput and the first rejected rows.
+    # With rebuild_indexes the table's secondary indexes and triggers are
+    # dropped for the load and rebuilt once at the end (including the products
+    # FTS index), which is much faster for very large feeds.
+    keys, columns = bulk_entity(entity)
+    statement = upsert_statement(entity)
+    connection = get_connection()
+    cursor = connection.cursor()
+    report = {"entity": entity, "imported": 0, "rejected": 0, "rejects": []}
+    started = time.perf_counter()
+
+    dropped = []
+    if rebuild_indexes:
+        if entity == 'stock':
+            # stock_counter_to_warehouse is dropped for the load, so remember
+            # which products were stocked per warehouse already
+            cursor.execute('DROP TABLE IF EXISTS temp.stocked_products')
+            cursor.execute('CREATE TEMP TABLE stocked_products AS SELECT DISTINCT product_id FROM stock')
+        cursor.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name=? AND sql IS NOT NULL", (entity,))
+        dropped = cursor.fetchall()
+        for kind, name, sql in dropped:
+            cursor.execute(f'DROP {kind.upper()} {name}')
+        connection.commit()
+
+    rejects = open(reject_path, 'w', encoding='utf-8') if reject_path else None
+    try:
+        chunk = []
+        for line_number, record in read_records(path, fmt):
+            row, reason = validate_record(columns, record)
+            if row is None:
+                report["rejected"] += 1
+                if len(report["rejects"]) < MAX_REPORTED_REJECTS:
+                    report["rejects"].append((line_number, reason))
+                if rejects:
+                    rejects.write(json.dumps({"line": line_number, "reason": reason, "record": record}) + '\n')
+                continue
+            chunk.append(row)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                run_write(write_bulk_rows, statement, chunk)
+                report["imported"] += len(chunk)
+                chunk = []
+        if chunk:
+            run_write(write_bulk_rows, statement, chunk)
+            report["imported"] += len(chunk)
+    finally:
+        if rejects:
+            rejects.close()
+        if dropped:
+            for kind, name, sql in dropped:
+                cursor.execute(sql)
+            if entity == 'products':
+                cursor.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+            connection.commit()
+        if rebuild_indexes and entity == 'stock':
+            cursor.execute(STOCK_COUNTERS_TO_WAREHOUSE.format(
+                condition='AND product_id NOT IN (SELECT product_id FROM temp.stocked_products)'))
+            cursor.execute('DROP TABLE temp.stocked_products')
+            connection.commit()
+        if entity in ('products', 'stock'):
+            # A products feed may overwrite derived totals, and with the stock
+            # triggers dropped nothing kept them in step
+            cursor.execute(SYNC_STOCK_TOTALS)
+            connection.commit()
+        if entity == 'products':
+            if dropped:
+                # cart_line_price was dropped with the other products triggers
+                run_write(write_revalue_carts)
+            revalue_sharded_carts()
+        if dropped and entity in ('products', 'categories', 'suppliers'):
+            # Their product_search triggers were dropped for the load
+            rebuild_product_search(cursor)
+            connection.commit()
+        # Any cached product or search may be stale now
+        product_cache.clear()
+        search_cache.clear()
+        facet_cache.clear()
+
+    report["seconds"] = time.perf_counter() - started
+    report["rows_per_second"] = report["imported"] / report["seconds"] if report["seconds"] else 0.0
+    return report
+
+def write_bulk_rows(cursor, statement, rows):
+    cursor.executemany(statement, rows)
+    return len(rows), []
+
+def export_records(entity, path, fmt=None):
+    # Streams the table to CSV or JSONL in key order; returns the row count
+    keys, columns = bulk_entity(entity)
+    names = [name for name, kind, required in columns]
+    fmt = file_format(path, fmt)
+    cursor = get_connection().cursor()
+    cursor.execute(f"SELECT {', '.join(names)} FROM {entity} ORDER BY {', '.join(keys)}")
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(names)
+        while True:
+            rows = cursor.fetchmany(IMPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                if writer:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(dict(zip(names, row))) + '\n')
+            count += len(rows)
+    return count
+
+
 def features():
     print("For search and filtering input 1")
 
@@ -286,167 +2092,335 @@ def search_and_filter_menu():
     category = input("Enter category (or leave blank for all): ")
     price_range = input("Enter price range (or leave blank for all): ")
     supplier_name = input("Enter brand: ")
-    search_products(category, price_range,supplier_name)
+    text = input("Enter search text (or leave blank): ")
+    if text:
+        products = full_text_search(text, category)
+        if not products:
+            print("No products match the search criteria.")
+        else:
+            print("Product ID | Name | Price | Stock Quantity | Category")
+            for product in products:
+                print(f"{product[0]} | {product[1]} | {product[2]} | {product[3]} | {product[4]} |")
+    else:
+        search_products(category, price_range,supplier_name)
 
-def view_products():
+def view_products(sort="product_id"):
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-            cursor.execute('SELECT * FROM products')
-            product_data = cursor.fetchall()
-
-            print("\nAvailable Products:")
-            for product in product_data:
-                print(f"Product ID: {product[0]}, Name: {product[2]}")
+        print("\nAvailable Products:")
+        for product in iter_products(sort):
+            print(f"Product ID: {product[0]}, Name: {product[1]}")
     except sqlite3.Error as e:
         print("Error:", e)
 
 def view_product_details(product_id,username):
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-            cursor.execute('SELECT * FROM products WHERE product_id = ?', (product_id,))
-            product_details = cursor.fetchone()
-
-            if product_details:
-                print("\nProduct Details:")
-                print(f"Product ID: {product_details[0]}")
-                print(f"Name: {product_details[3]}")
-                print(f"Price: ${product_details[1]}")
-                print(f"Stock Quantity: {product_details[4]}")
-                # Add more details as needed
-            else:
-                print("Product not found.")
-            menu(username)
-    except sqlite3.Error as e:
+        product_details = get_product(product_id)
+
+        if product_details:
+            print("\nProduct Details:")
+            print(f"Product ID: {product_details[0]}")
+            print(f"Name: {product_details[1]}")
+            print(f"Price: ${product_details[2]}")
+            print(f"Stock Quantity: {product_details[3]}")
+            # Add more details as needed
+        else:
+            print("Product not found.")
+    except (sqlite3.Error, ValueError) as e:
         print("Error:", e)
 
+def write_take_basket(cursor, items, warehouse_order=None):
+    # Takes the stock of a whole basket of (product_id, quantity) lines. Returns
+    # (failed, lines) with lines of (product_id, quantity, price, allocations);
+    # nothing is kept unless failed is empty.
+    failed = []
+    lines = []
+    touched = []
+    cursor.execute('SAVEPOINT basket')
+    for product_id, quantity in items:
+        taken = take_stock(cursor, product_id, quantity, warehouse_order)
+        if taken is None:
+            failed.append(product_id)
+            continue
+        price, category_id, allocations = taken
+        lines.append((product_id, quantity, price, allocations))
+        touched.append((product_id, [category_id]))
+    if failed:
+        cursor.execute('ROLLBACK TO basket')
+        lines = []
+        touched = []
+    cursor.execute('RELEASE basket')
+    return (failed, lines), touched
+
+def write_return_stock(cursor, lines):
+    # Puts back the stock write_take_basket took for lines
+    touched = []
+    for product_id, quantity, price, allocations in lines:
+        if allocations:
+            cursor.executemany('UPDATE stock SET quantity = quantity + ? WHERE product_id = ? AND warehouse_id = ?',
+                               [(amount, product_id, warehouse_id) for warehouse_id, amount in allocations])
+        else:
+            cursor.execute('UPDATE products SET stock_quantity = stock_quantity + ? WHERE product_id = ?', (quantity, product_id))
+        touched.append((product_id, None))
+    return None, touched
+
+def write_cart_lines(cursor, user_id, lines):
+    # Adds lines taken by write_take_basket to the user's cart, remembering
+    # their warehouses in stock_allocations
+    for product_id, quantity, price, allocations in lines:
+        # Adding a product already in the cart tops up its line
+        cursor.execute('''
+            INSERT INTO shopping_carts (user_id, product_id, amount, total_cost) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, product_id) DO UPDATE
+            SET amount = amount + excluded.amount, total_cost = total_cost + excluded.total_cost
+        ''', (user_id, product_id, quantity, quantity * (price or 0)))
+        if allocations:
+            cursor.executemany('''
+                INSERT INTO stock_allocations (user_id, product_id, warehouse_id, quantity) VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id, product_id, warehouse_id) DO UPDATE SET quantity = quantity + excluded.quantity
+            ''', [(user_id, product_id, warehouse_id, amount) for warehouse_id, amount in allocations])
+    return None, []
+
+def write_reservation(cursor, user_id, items, warehouse_order=None):
+    # Reserve a whole basket of (product_id, quantity) lines. Returns the product
+    # IDs that could not be reserved; nothing is kept unless that list is empty.
+    # Warehouse stock is filled per take_stock and remembered in stock_allocations.
+    (failed, lines), touched = write_take_basket(cursor, items, warehouse_order)
+    write_cart_lines(cursor, user_id, lines)
+    return failed, touched
+
+def run_taken_write(user_id, lines, operation, *args):
+    # Runs the shard half of a sharded reservation or order; when it fails the
+    # stock the catalog half took goes back
+    try:
+        return run_order_write(user_id, operation, *args)
+    except BaseException:
+        run_write(write_return_stock, lines)
+        raise
+
+def reserve_items(user_id, items, warehouse_order=None):
+    # The basket's stock and cart lines commit in one IMMEDIATE transaction,
+    # or with shards one on the catalog and one on the user's shard
+    if SHARDS > 1:
+        failed, lines = run_write(write_take_basket, items, warehouse_order)
+        if lines:
+            run_taken_write(user_id, lines, write_cart_lines, user_id, lines)
+        return failed
+    return run_write(write_reservation, user_id, items, warehouse_order)
 
 def add_to_shopping_cart(username, product_id, quantity):
     user_id = get_user_id(username)
-    with sqlite3.connect(DATABASE) as connection:
-        cursor = connection.cursor()
-
-        # Check if there is enough stock
-        cursor.execute('SELECT stock_quantity FROM products WHERE product_id=?', (product_id,))
-        current_stock = cursor.fetchone()[0]
+    try:
+        if reserve_items(user_id, [(product_id, quantity)]):
+            print("Insufficient stock. Unable to add to the shopping cart.")
+        else:
+            print("Product added to the shopping cart successfully!")
+    except sqlite3.Error as e:
+        print("Error:", e)
 
-        if current_stock >= quantity:
-            # Deduct the quantity from stock
-            cursor.execute('UPDATE products SET stock_quantity = stock_quantity - ? WHERE product_id=?', (quantity, product_id))
 
-            # Add the product to the shopping cart
-            cursor.execute('INSERT INTO shopping_carts (user_id, product_id, quantity) VALUES (?, ?, ?)', (user_id, product_id, quantity))
 
-            connection.commit()
-            print("Product added to the shopping cart successfully!")
-        else:
-            print("Insufficient stock. Unable to add to the shopping cart.")
-        menu(username)
 
+def cart_lines(user_id):
+    # Returns (product_id, product_name, quantity, price, line_total, cart_total)
+    # rows for the user's cart, in the order the products were first added;
+    # both totals come from the same query
+    cursor = order_connection(user_id).cursor()
+    cursor.execute('''
+        SELECT products.product_id, products.name, shopping_carts.amount, products.price,
+               shopping_carts.amount * products.price,
+               SUM(shopping_carts.amount * products.price) OVER ()
+        FROM shopping_carts
+        JOIN products ON shopping_carts.product_id = products.product_id
+        WHERE shopping_carts.user_id = ?
+        ORDER BY shopping_carts.cart_id
+    ''', (user_id,))
+    return cursor.fetchall()
 
+def cart_total(user_id):
+    # Returns (items, total_cost) from the maintained carts row, without reading the lines
+    cursor = order_connection(user_id).cursor()
+    cursor.execute('SELECT items, total_cost FROM carts WHERE user_id = ?', (user_id,))
+    return cursor.fetchone() or (0, 0.0)
 
 def view_shopping_cart(user_id):
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-
-            cursor.execute('''
-                SELECT products.product_id, products.name, shopping_carts.quantity, products.price
-                FROM shopping_carts
-                JOIN products ON shopping_carts.product_id = products.product_id
-                WHERE shopping_carts.user_id = ?
-            ''', (user_id,))
-
-            cart_items = cursor.fetchall()
+        cart_items = cart_lines(user_id)
 
-            if not cart_items:
-                print("Shopping cart is empty.")
-            else:
-                total_cost = 0.0
-                print("Shopping Cart:")
-                print("Product ID | Product Name | Quantity | Price | Total Cost")
-                for item in cart_items:
-                    product_id, product_name, quantity, price = item
-                    total_item_cost = quantity * price
-                    total_cost += total_item_cost
-                    print(f"{product_id} | {product_name} | {quantity} | ${price:.2f} | ${total_item_cost:.2f}")
-                print(f"Total Cost: ${total_cost:.2f}")
-        menu(username)
+        if not cart_items:
+            print("Shopping cart is empty.")
+        else:
+            print("Shopping Cart:")
+            print("Product ID | Product Name | Quantity | Price | Total Cost")
+            for item in cart_items:
+                product_id, product_name, quantity, price, total_item_cost, total_cost = item
+                print(f"{product_id} | {product_name} | {quantity} | ${price:.2f} | ${total_item_cost:.2f}")
+            print(f"Total Cost: ${total_cost:.2f}")
 
     except sqlite3.Error as e:
         print("Error:", e)
 
 
 
+def write_order(cursor, user_id, courier_info, shipping_address, items=None, warehouse_order=None):
+    # The order, its items, the stock, the rollups and the cart clear go in
+    # together. With items=None the user's cart is ordered; its stock was
+    # already taken by write_reservation, so only lines whose product has
+    # disappeared can fail. With an explicit list of (product_id, quantity)
+    # lines the stock is taken here instead (see take_stock). Returns
+    # (tracking_id, total_cost, failed); nothing is kept when failed is non-empty.
+    touched = []
+    allocations = None
+    cursor.execute('SAVEPOINT checkout')
+    if items is None:
+        cursor.execute('''
+            SELECT shopping_carts.product_id, SUM(shopping_carts.amount), products.price
+            FROM shopping_carts
+            LEFT JOIN products ON shopping_carts.product_id = products.product_id
+            WHERE shopping_carts.user_id = ?
+            GROUP BY shopping_carts.product_id
+        ''', (user_id,))
+        lines = cursor.fetchall()
+        failed = [product_id for product_id, quantity, price in lines if price is None]
+    else:
+        (failed, taken), touched = write_take_basket(cursor, merge_items(items), warehouse_order)
+        lines = [(product_id, quantity, price) for product_id, quantity, price, taken_from in taken]
+        allocations = [(product_id, warehouse_id, amount)
+                       for product_id, quantity, price, taken_from in taken for warehouse_id, amount in taken_from]
+
+    if failed or not lines:
+        cursor.execute('ROLLBACK TO checkout')
+        cursor.execute('RELEASE checkout')
+        return (None, 0.0, failed), []
+
+    tracking_id, total_cost = insert_order(cursor, user_id, courier_info, shipping_address, lines, allocations)
+    cursor.execute('RELEASE checkout')
+    return (tracking_id, total_cost, []), touched
+
+def write_taken_order(cursor, user_id, courier_info, shipping_address, lines):
+    # Orders lines whose stock write_take_basket has already taken
+    tracking_id, total_cost = insert_order(
+        cursor, user_id, courier_info, shipping_address,
+        [(product_id, quantity, price) for product_id, quantity, price, taken_from in lines],
+        [(product_id, warehouse_id, amount) for product_id, quantity, price, taken_from in lines for warehouse_id, amount in taken_from])
+    return (tracking_id, total_cost, []), []
+
+def merge_items(items):
+    # One (product_id, quantity) line per product, in first-seen order
+    merged = {}
+    for product_id, quantity in items:
+        merged[product_id] = merged.get(product_id, 0) + quantity
+    return list(merged.items())
+
+def insert_order(cursor, user_id, courier_info, shipping_address, lines, allocations=None):
+    # Writes the order, its (product_id, quantity, price) items and the rollups;
+    # returns (tracking_id, total_cost). With allocations=None the user's cart
+    # is what was ordered: its warehouse allocations become the order's and it
+    # is cleared.
+    total_cost = sum(quantity * price for product_id, quantity, price in lines)
+    tracking_id = generate_tracking_id()
+    created_at = time.time()
+    cursor.execute('''
+        INSERT INTO orders (tracking_id, user_id, courier_info, shipping_address, total_cost, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        RETURNING order_id
+    ''', (tracking_id, user_id, courier_info, shipping_address, total_cost, created_at))
+    order_id = cursor.fetchone()[0]
+    cursor.executemany('INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)',
+                       [(order_id, product_id, quantity, price) for product_id, quantity, price in lines])
+    write_sales_rollups(cursor, lines, total_cost, created_at)
+    if allocations is None:
+        # The cart's warehouse allocations become the order's
+        cursor.execute('''
+            INSERT INTO order_allocations (order_id, product_id, warehouse_id, quantity)
+            SELECT ?, product_id, warehouse_id, quantity FROM stock_allocations WHERE user_id = ?
+        ''', (order_id, user_id))
+        cursor.execute('DELETE FROM stock_allocations WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM shopping_carts WHERE user_id = ?', (user_id,))
+    else:
+        cursor.executemany('INSERT INTO order_allocations (order_id, product_id, warehouse_id, quantity) VALUES (?, ?, ?, ?)',
+                           [(order_id, product_id, warehouse_id, amount) for product_id, warehouse_id, amount in allocations])
+    return tracking_id, total_cost
+
+def place_order(user_id, courier_info, shipping_address, items=None, warehouse_order=None):
+    # Checks out in one transaction; see write_order. With shards, an explicit
+    # list of items takes its stock first, as reserve_items does.
+    if SHARDS > 1 and items is not None:
+        failed, lines = run_write(write_take_basket, merge_items(items), warehouse_order)
+        if not lines:
+            return None, 0.0, failed
+        return run_taken_write(user_id, lines, write_taken_order, user_id, courier_info, shipping_address, lines)
+    return run_order_write(user_id, write_order, user_id, courier_info, shipping_address, items, warehouse_order)
+
 def checkout(username, shipping_address):
     user_id = get_user_id(username)
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-
-            # Retrieve the user's shopping cart
-            cursor.execute('SELECT * FROM shopping_carts WHERE user_id = ?', (user_id,))
-            cart_data = cursor.fetchone()
-
-            if cart_data:
-                cart_id, user_id, total_cost = cart_data
-
-                # Retrieve the cart items
-                cursor.execute('SELECT * FROM cart_items WHERE cart_id = ?', (cart_id,))
-                cart_items = cursor.fetchall()
-
-                # Perform the checkout process
-                tracking_id = generate_tracking_id()
-                courier_info = input("Enter courier information: ")
-
-                # Generate a simple payment receipt
-                payment_receipt = generate_payment_receipt(cart_items, total_cost)
-
-                # Insert the order details into the transaction_receipts table
-                cursor.execute('''
-                    INSERT INTO transaction_receipts (tracking_id, courier_info, payment_receipt)
-                    VALUES (?, ?, ?)
-                ''', (tracking_id, courier_info, payment_receipt))
-
-                # Update product stock levels and deduct from the inventory
-                for cart_item in cart_items:
-                    product_id, quantity = cart_item[2], cart_item[3]
-                    update_stock(product_id, -quantity)  # Deduct quantity from stock
-
-                # Clear the user's shopping cart
-                cursor.execute('DELETE FROM shopping_carts WHERE user_id = ?', (user_id,))
-
-                print("Checkout successful!")
-                print(f"Tracking ID: {tracking_id}")
-                print("Payment Receipt:")
-                print(payment_receipt)
-            else:
-                print("Shopping cart is empty. Add products before checking out.")
-            menu(username)
+        courier_info = input("Enter courier information: ")
+        tracking_id, total_cost, failed = place_order(user_id, courier_info, shipping_address)
+
+        if failed:
+            print("Checkout failed. These products are no longer available:")
+            for product_id in failed:
+                print(f"Product ID: {product_id}")
+        elif tracking_id is None:
+            print("Shopping cart is empty. Add products before checking out.")
+        else:
+            print("Checkout successful!")
+            print(f"Tracking ID: {tracking_id}")
+            print("Payment Receipt:")
+            print(order_receipt(tracking_id, user_id))
     except sqlite3.Error as e:
         print("Error:", e)
 
-def generate_tracking_id():
-    # Using a simple timestamp-based approach for a unique tracking ID
-    return int(time.time())
+# Tracking IDs are ULID-style: 48 bits of milliseconds and 80 random bits in
+# 26 Crockford base32 characters. They sort by time, and IDs made in the same
+# millisecond by this process increment, so they never collide or go backwards.
+TRACKING_ID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_tracking_id_lock = threading.Lock()
+_last_tracking_id = 0
 
-def generate_payment_receipt(cart_items, total_cost):
-    # Generate a simple payment receipt based on cart items and total cost
+def generate_tracking_id():
+    global _last_tracking_id
+    with _tracking_id_lock:
+        value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), 'big')
+        if value <= _last_tracking_id:
+            value = _last_tracking_id + 1
+        _last_tracking_id = value
+    characters = []
+    for _ in range(26):
+        characters.append(TRACKING_ID_ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(characters))
+
+def order_receipt(tracking_id, user_id=None):
+    # Rebuilds the payment receipt of a placed order, or None if there is no
+    # such order. Without the user_id every shard is looked in.
+    if SHARDS > 1 and user_id is None:
+        connections = [get_shard_connection(shard) for shard in range(SHARDS)]
+    else:
+        connections = [order_connection(user_id)]
+    for connection in connections:
+        cursor = connection.cursor()
+        cursor.execute('SELECT order_id, total_cost FROM orders WHERE tracking_id = ?', (tracking_id,))
+        order = cursor.fetchone()
+        if order is not None:
+            cursor.execute('SELECT product_id, quantity, price FROM order_items WHERE order_id = ?', (order[0],))
+            return generate_payment_receipt(cursor.fetchall(), order[1])
+    return None
+
+def generate_payment_receipt(order_lines, total_cost):
+    # Generate a simple payment receipt from (product_id, quantity, price) lines
     receipt_lines = []
     receipt_lines.append("Payment Receipt")
     receipt_lines.append("-" * 30)
-    for cart_item in cart_items:
-        product_id, quantity = cart_item[2], cart_item[3]
-        receipt_lines.append(f"Product ID: {product_id}, Quantity: {quantity}")
+    for product_id, quantity, price in order_lines:
+        receipt_lines.append(f"Product ID: {product_id}, Quantity: {quantity}, Price: ${price:.2f}")
     receipt_lines.append("-" * 30)
-    receipt_lines.append(f"Total Cost: ${total_cost}")
+    receipt_lines.append(f"Total Cost: ${total_cost:.2f}")
     return "\n".join(receipt_lines)
 
-def add_to_cart_menu(username,user_id, product_id, quantity):
+def add_to_cart_menu(username, product_id, quantity):
     print("\nAdd to Shopping Cart:")
-    add_to_shopping_cart(user_id, product_id, quantity)
-    menu(username)
+    add_to_shopping_cart(username, product_id, quantity)
 
 
 
@@ -488,92 +2462,830 @@ def assign_category_menu():
     category_id = int(input("Enter the category ID: "))
     assign_category(product_id, category_id)
 
-def generate_sales_report():
+# Sales rollups
+# Checkout adds each order to these tables in its own transaction, so the
+# reports read a handful of precomputed rows instead of the order history.
+# rebuild_sales_rollups() regenerates them from order_items.
+SALES_ROLLUP_TABLES = ('product_sales', 'product_sales_hourly', 'sales_daily')
+
+def write_sales_rollups(cursor, lines, total_cost, created_at):
+    per_product = {}
+    for product_id, quantity, price in lines:
+        total_quantity, revenue = per_product.get(product_id, (0, 0.0))
+        per_product[product_id] = (total_quantity + quantity, revenue + quantity * price)
+    hour = int(created_at // 3600)
+    cursor.executemany('''
+        INSERT INTO product_sales (product_id, purchase_count, quantity, revenue) VALUES (?, 1, ?, ?)
+        ON CONFLICT (product_id) DO UPDATE SET purchase_count = purchase_count + 1,
+            quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue
+    ''', [(product_id, quantity, revenue) for product_id, (quantity, revenue) in per_product.items()])
+    cursor.executemany('''
+        INSERT INTO product_sales_hourly (product_id, hour, purchase_count, quantity, revenue) VALUES (?, ?, 1, ?, ?)
+        ON CONFLICT (product_id, hour) DO UPDATE SET purchase_count = purchase_count + 1,
+            quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue
+    ''', [(product_id, hour, quantity, revenue) for product_id, (quantity, revenue) in per_product.items()])
+    cursor.execute('''
+        INSERT INTO sales_daily (day, orders, revenue) VALUES (date(?, 'unixepoch'), 1, ?)
+        ON CONFLICT (day) DO UPDATE SET orders = orders + 1, revenue = revenue + excluded.revenue
+    ''', (created_at, total_cost))
+
+def write_rebuild_sales_rollups(cursor, reset_demand_models=False):
+    for table in SALES_ROLLUP_TABLES:
+        cursor.execute(f'DELETE FROM {table}')
+    cursor.execute('''
+        INSERT INTO product_sales (product_id, purchase_count, quantity, revenue)
+        SELECT product_id, COUNT(DISTINCT order_id), SUM(quantity), SUM(quantity * price)
+        FROM order_items
+        GROUP BY product_id
+    ''')
+    cursor.execute('''
+        INSERT INTO product_sales_hourly (product_id, hour, purchase_count, quantity, revenue)
+        SELECT order_items.product_id, CAST(orders.created_at / 3600 AS INTEGER) AS hour,
+               COUNT(DISTINCT order_items.order_id), SUM(order_items.quantity), SUM(order_items.quantity * order_items.price)
+        FROM order_items
+        JOIN orders ON order_items.order_id = orders.order_id
+        GROUP BY order_items.product_id, hour
+    ''')
+    cursor.execute('''
+        INSERT INTO sales_daily (day, orders, revenue)
+        SELECT date(created_at, 'unixepoch') AS day, COUNT(*), SUM(total_cost)
+        FROM orders
+        GROUP BY day
+    ''')
+    if reset_demand_models:
+        write_reset_demand_models(cursor)
+    return None, []
+
+def write_reset_demand_models(cursor):
+    # The demand models' window sums came from the old rollups; refit from scratch
+    cursor.execute('DELETE FROM demand_model_window')
+    return None, []
+
+def rebuild_sales_rollups():
+    if SHARDS > 1:
+        run_shard_writes(write_rebuild_sales_rollups)
+        run_write(write_reset_demand_models)
+    else:
+        run_write(write_rebuild_sales_rollups, True)
+
+# Reporting snapshot
+# With REPORTING_SNAPSHOT on, the report functions read a copy of the database
+# made with the sqlite3 backup API instead of the live file, so analytics
+# never hold locks or evict pages that checkout needs. A report finding the
+# copy older than SNAPSHOT_MAX_AGE refreshes it first (while other threads keep
+# reading the old one); `python OSS6.py refresh-snapshot --every N` refreshes
+# it on a schedule instead. Each report states how old its data is.
+REPORTING_SNAPSHOT = False
+SNAPSHOT_DATABASE = None  # defaults to "<database>.report.db" next to DATABASE
+SNAPSHOT_MAX_AGE = 300.0
+# -1 copies in one read transaction, which WAL lets run beside the writers; a
+# positive page count copies in steps but restarts whenever the source changes
+SNAPSHOT_PAGES_PER_STEP = -1
+
+_snapshot_lock = threading.Lock()
+
+def snapshot_path():
+    if SNAPSHOT_DATABASE:
+        return SNAPSHOT_DATABASE
+    stem, extension = os.path.splitext(DATABASE)
+    return f"{stem}.report{extension or '.db'}"
+
+def refresh_snapshot():
+    # Copies the live database into a new snapshot and swaps it in atomically;
+    # returns the time the copy was taken
+    path = snapshot_path()
+    # Each copy gets its own file, as other processes may be refreshing too;
+    # the last one to finish wins
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                             prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(descriptor)
+    # mkstemp makes it private; the copy holds everything, so it gets the live file's mode
+    os.chmod(temporary, stat.S_IMODE(os.stat(DATABASE).st_mode))
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-
-            # Retrieve total sales and revenue
-            cursor.execute('''
-                SELECT SUM(total_cost) as total_sales, COUNT(*) as total_orders
-                FROM transaction_receipts
-            ''')
-            sales_data = cursor.fetchone()
+        source = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT)
+        target = sqlite3.connect(temporary)
+        try:
+            taken_at = time.time()
+            source.backup(target, pages=SNAPSHOT_PAGES_PER_STEP)
+            # Readers open the copy read-only, which a WAL database does not allow
+            target.execute("PRAGMA journal_mode=DELETE")
+            target.execute("CREATE TABLE snapshot_info (taken_at REAL)")
+            target.execute("INSERT INTO snapshot_info (taken_at) VALUES (?)", (taken_at,))
+            target.commit()
+        finally:
+            target.close()
+            source.close()
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return taken_at
+
+def snapshot_identity(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+def open_snapshot(path, identity):
+    connection = getattr(_local, "report_connection", None)
+    if connection is not None:
+        connection.close()
+    connection = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True,
+                                 cached_statements=CACHED_STATEMENTS,
+                                 factory=InstrumentedConnection if QUERY_STATS else sqlite3.Connection)
+    _local.report_connection = connection
+    _local.report_identity = identity
+    _local.report_instrumented = QUERY_STATS
+    _local.report_taken_at = connection.execute("SELECT taken_at FROM snapshot_info").fetchone()[0]
+    return connection
+
+def get_report_connection():
+    # The connection report queries run on: this thread's snapshot connection
+    # in reporting mode, reopened whenever the snapshot file is replaced
+    if not REPORTING_SNAPSHOT:
+        return get_connection()
+    path = snapshot_path()
+    identity = snapshot_identity(path)
+    if identity is None or time.time() - getattr(_local, "report_taken_at", 0) > SNAPSHOT_MAX_AGE:
+        if identity is not None and getattr(_local, "report_identity", None) != identity:
+            # Another thread or process may have refreshed it already
+            open_snapshot(path, identity)
+        if identity is None or time.time() - _local.report_taken_at > SNAPSHOT_MAX_AGE:
+            # Only the first thread to notice refreshes; with a snapshot to
+            # fall back on the others carry on with it
+            if _snapshot_lock.acquire(blocking=identity is None):
+                try:
+                    if snapshot_identity(path) == identity:
+                        refresh_snapshot()
+                finally:
+                    _snapshot_lock.release()
+            identity = snapshot_identity(path)
+    if getattr(_local, "report_identity", None) != identity or getattr(_local, "report_instrumented", None) != QUERY_STATS:
+        open_snapshot(path, identity)
+    return _local.report_connection
+
+def report_freshness():
+    # How current the data behind this thread's last report is; sharded
+    # reports read the live shards, not a snapshot
+    if not REPORTING_SNAPSHOT or SHARDS > 1:
+        return {"source": "shards" if SHARDS > 1 else "live", "as_of": time.time(), "age_seconds": 0.0}
+    taken_at = getattr(_local, "report_taken_at", None)
+    return {"source": "snapshot", "as_of": taken_at, "age_seconds": time.time() - taken_at if taken_at else None}
+
+def print_report_freshness():
+    if REPORTING_SNAPSHOT and SHARDS <= 1:
+        freshness = report_freshness()
+        print(f"Data as of {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(freshness['as_of']))} "
+              f"({freshness['age_seconds']:.0f} seconds old)")
+
+def sales_report():
+    # Returns (total_sales, total_orders)
+    totals = [rows[0] for rows in fan_out('''
+        SELECT SUM(revenue) as total_sales, COALESCE(SUM(orders), 0) as total_orders
+        FROM sales_daily
+    ''')]
+    sales = [total_sales for total_sales, total_orders in totals if total_sales is not None]
+    return (sum(sales) if sales else None), sum(total_orders for total_sales, total_orders in totals)
+
+def popular_products_report(limit=5):
+    # Returns (product_name, purchase_count) rows, most purchased first
+    cursor = get_report_connection().cursor()
+    if SHARDS > 1:
+        counts = {}
+        for rows in fan_out('SELECT product_id, purchase_count FROM product_sales'):
+            for product_id, purchase_count in rows:
+                counts[product_id] = counts.get(product_id, 0) + purchase_count
+        ranked = sorted(counts, key=lambda product_id: (-counts[product_id], product_id))
+        report = []
+        # Deleted products drop out, so names are looked up a page at a time
+        for start in range(0, len(ranked), max(limit, 1)):
+            page = ranked[start:start + max(limit, 1)]
+            cursor.execute('SELECT product_id, name FROM products WHERE product_id IN (SELECT value FROM json_each(?))',
+                           (json.dumps(page),))
+            names = dict(cursor.fetchall())
+            report.extend((names[product_id], counts[product_id]) for product_id in page if product_id in names)
+            if len(report) >= limit:
+                break
+        return report[:limit]
+    cursor.execute('''
+        SELECT products.name, product_sales.purchase_count
+        FROM product_sales
+        JOIN products ON product_sales.product_id = products.product_id
+        ORDER BY product_sales.purchase_count DESC
+        LIMIT ?
+    ''', (limit,))
+    return cursor.fetchall()
+
+def hourly_sales_report(product_id, start_hour=0, end_hour=None):
+    # Returns (hour, purchase_count, quantity, revenue) rows; hours are Unix time // 3600
+    merged = {}
+    for rows in fan_out('''
+        SELECT hour, purchase_count, quantity, revenue
+        FROM product_sales_hourly
+        WHERE product_id = ? AND hour >= ? AND hour <= ?
+    ''', (product_id, start_hour, end_hour if end_hour is not None else 2**62)):
+        for hour, purchase_count, quantity, revenue in rows:
+            totals = merged.get(hour, (0, 0, 0.0))
+            merged[hour] = (totals[0] + purchase_count, totals[1] + quantity, totals[2] + revenue)
+    return [(hour,) + merged[hour] for hour in sorted(merged)]
 
-            if sales_data:
-                total_sales, total_orders = sales_data
-                print("Sales Report:")
-                print(f"Total Sales: ${total_sales}")
-                print(f"Total Orders: {total_orders}")
-            else:
-                print("No sales data available.")
+def generate_sales_report():
+    try:
+        # Retrieve total sales and revenue
+        sales_data = sales_report()
+
+        if sales_data:
+            total_sales, total_orders = sales_data
+            print("Sales Report:")
+            print_report_freshness()
+            print(f"Total Sales: ${total_sales}")
+            print(f"Total Orders: {total_orders}")
+        else:
+            print("No sales data available.")
     except sqlite3.Error as e:
         print("Error:", e)
 
 def generate_popular_products_report():
     try:
-        with sqlite3.connect(DATABASE) as connection:
-            cursor = connection.cursor()
-
-            # Retrieve popular products based on the number of times they were purchased
-            cursor.execute('''
-                SELECT products.name, COUNT(*) as purchase_count
-                FROM transaction_receipts
-                JOIN cart_items ON transaction_receipts.tracking_id = cart_items.tracking_id
-                JOIN products ON cart_items.product_id = products.product_id
-                GROUP BY products.product_id
-                ORDER BY purchase_count DESC
-                LIMIT 5
-            ''')
-            popular_products = cursor.fetchall()
+        # Retrieve popular products based on the number of times they were purchased
+        popular_products = popular_products_report()
+
+        if popular_products:
+            print("Popular Products Report:")
+            print_report_freshness()
+            for product in popular_products:
+                product_name, purchase_count = product
+                print(f"{product_name}: {purchase_count} purchases")
+        else:
+            print("No popular products data available.")
+    except sqlite3.Error as e:
+        print("Error:", e)
 
-            if popular_products:
-                print("Popular Products Report:")
-                for product in popular_products:
-                    product_name, purchase_count = product
-                    print(f"{product_name}: {purchase_count} purchases")
-            else:
-                print("No popular products data available.")
+# Demand forecasting
+# Fits a linear trend of daily units sold to every product over the last
+# FORECAST_WINDOW_DAYS complete days, then recommends restocking each product
+# (per warehouse where it has warehouse stock) up to the demand expected over
+# the next cover days times RESTOCK_SAFETY_FACTOR. All products are fitted in
+# one least-squares solve. demand_models keeps each product's sums over the
+# window, so the nightly refit only reads the days entering and leaving it.
+# NumPy is optional and only imported when a forecast runs.
+FORECAST_WINDOW_DAYS = 28
+RESTOCK_COVER_DAYS = 14
+RESTOCK_SAFETY_FACTOR = 1.2
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError("Demand forecasting needs NumPy (pip install numpy)") from e
+    return numpy
+
+def daily_sales(np, ranges):
+    # Returns (product_ids, days, quantities) arrays of the units sold per
+    # product and Unix day within the given inclusive (first_day, last_day)
+    # ranges; with shards a (product, day) can appear once per shard. It reads
+    # the live data: the models keep running sums, so a day read from a
+    # snapshot taken before it ended would never be corrected.
+    conditions = " OR ".join(["(hour >= ? AND hour < ?)"] * len(ranges))
+    results = fan_out(f'''
+        SELECT product_id, hour / 24 AS day, SUM(quantity)
+        FROM product_sales_hourly
+        WHERE {conditions}
+        GROUP BY product_id, day
+    ''', [bound for first_day, last_day in ranges for bound in (first_day * 24, (last_day + 1) * 24)], live=True)
+    rows = np.array([row for rows in results for row in rows], dtype=np.float64).reshape(-1, 3)
+    return rows[:, 0].astype(np.int64), rows[:, 1].astype(np.int64), rows[:, 2]
+
+def product_columns(np, product_ids, ids):
+    # Positions of ids in the sorted product_ids, and which ids are found there
+    if not len(product_ids):
+        return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+    columns = np.minimum(np.searchsorted(product_ids, ids), len(product_ids) - 1)
+    return columns, product_ids[columns] == ids
+
+def demand_design(np):
+    # Rows [1, t] for the window's days t = 0, 1, ...; the same for every product
+    return np.column_stack([np.ones(FORECAST_WINDOW_DAYS), np.arange(FORECAST_WINDOW_DAYS, dtype=np.float64)])
+
+def fit_demand_models(full=False, today=None):
+    # Refits the models through yesterday (today is a Unix day); returns what was done
+    np = import_numpy()
+    started = time.perf_counter()
+    cursor = get_connection().cursor()
+    last_day = (int(time.time() // 86400) if today is None else today) - 1
+    first_day = last_day - FORECAST_WINDOW_DAYS + 1
+    cursor.execute('SELECT first_day, last_day FROM demand_model_window')
+    state = cursor.fetchone()
+    cursor.execute('SELECT product_id FROM products ORDER BY product_id')
+    product_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+    design = demand_design(np)
+    shift = last_day - state[1] if state else 0
+    if state and not full and state == (first_day, last_day):
+        mode = "current"
+    elif full or state is None or state[1] - state[0] + 1 != FORECAST_WINDOW_DAYS or not 0 < shift < FORECAST_WINDOW_DAYS:
+        mode = "full"
+        ids, days, quantities = daily_sales(np, [(first_day, last_day)])
+        columns, found = product_columns(np, product_ids, ids)
+        history = np.zeros((FORECAST_WINDOW_DAYS, len(product_ids)))
+        np.add.at(history, (days[found] - first_day, columns[found]), quantities[found])
+        coefficients = np.linalg.lstsq(design, history, rcond=None)[0]
+        sums = design.T @ history
+    else:
+        mode = "incremental"
+        old_first_day, old_last_day = state
+        cursor.execute('SELECT product_id, sum_quantity, sum_day_quantity FROM demand_models')
+        stored = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+        columns, found = product_columns(np, product_ids, stored[:, 0].astype(np.int64))
+        sums = np.zeros((2, len(product_ids)))
+        sums[:, columns[found]] = stored[found, 1:].T
+        # Days that left the window count negatively; t is still counted from
+        # the old first day until the origin moves below
+        ids, days, quantities = daily_sales(np, [(old_first_day, first_day - 1), (old_last_day + 1, last_day)])
+        columns, found = product_columns(np, product_ids, ids)
+        signed = np.where(days < first_day, -quantities, quantities)[found]
+        sums[0] += np.bincount(columns[found], weights=signed, minlength=len(product_ids))
+        sums[1] += np.bincount(columns[found], weights=signed * (days[found] - old_first_day), minlength=len(product_ids))
+        sums[1] -= shift * sums[0]
+        # The normal equations of the same fit; quantities are whole numbers,
+        # so the sums stay exact however many refits they go through
+        coefficients = np.linalg.solve(design.T @ design, sums)
+    if mode != "current":
+        rows = zip(product_ids.tolist(), sums[0].tolist(), sums[1].tolist(), coefficients[0].tolist(), coefficients[1].tolist())
+        if not run_write(write_demand_models, list(rows), first_day, last_day, state):
+            mode = "superseded"
+    return {"mode": mode, "products": len(product_ids), "first_day": first_day, "last_day": last_day,
+            "seconds": round(time.perf_counter() - started, 3)}
+
+def write_demand_models(cursor, rows, first_day, last_day, state):
+    # A refit computed from a window another refit has since moved is dropped
+    cursor.execute('SELECT first_day, last_day FROM demand_model_window')
+    if cursor.fetchone() != state:
+        return False, []
+    cursor.execute('DELETE FROM demand_models')
+    cursor.executemany('''
+        INSERT INTO demand_models (product_id, sum_quantity, sum_day_quantity, intercept, slope) VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    cursor.execute('INSERT OR REPLACE INTO demand_model_window (id, first_day, last_day, fitted_at) VALUES (1, ?, ?, ?)',
+                   (first_day, last_day, time.time()))
+    return True, []
+
+def restock_recommendations(cover_days=RESTOCK_COVER_DAYS, limit=None):
+    # Returns (product_id, name, warehouse_id, stock, forecast_demand, restock_quantity)
+    # rows, largest restock first; warehouse_id is None for products stocked
+    # only through stock_quantity
+    np = import_numpy()
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT first_day, last_day FROM demand_model_window')
+    state = cursor.fetchone()
+    if state is None:
+        raise ValueError("Demand models have not been fitted yet")
+    cursor.execute('''
+        SELECT demand_models.product_id, products.name, COALESCE(products.stock_quantity, 0),
+               demand_models.intercept, demand_models.slope
+        FROM demand_models
+        JOIN products ON products.product_id = demand_models.product_id
+        ORDER BY demand_models.product_id
+    ''')
+    rows = cursor.fetchall()
+    names = [row[1] for row in rows]
+    product_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    stock, intercept, slope = np.array([row[2:] for row in rows], dtype=np.float64).reshape(-1, 3).T
+    future = np.arange(state[1] + 1, state[1] + 1 + cover_days) - state[0]
+    demand = np.clip(intercept[:, None] + slope[:, None] * future, 0, None).sum(axis=1)
+    target = np.ceil(demand * RESTOCK_SAFETY_FACTOR)
+
+    # Each warehouse restocks its share of the target: its share of what the
+    # product has shipped, or an even split before anything has
+    shipped = {}
+    for rows in fan_out('''
+        SELECT product_id, warehouse_id, SUM(quantity) FROM order_allocations GROUP BY product_id, warehouse_id
+    '''):
+        for product_id, warehouse_id, quantity in rows:
+            shipped[product_id, warehouse_id] = shipped.get((product_id, warehouse_id), 0) + quantity
+    cursor.execute('SELECT product_id, warehouse_id, COALESCE(quantity, 0) FROM stock')
+    lines = np.array([row + (shipped.get(row[:2], 0),) for row in cursor.fetchall()], dtype=np.float64).reshape(-1, 4)
+    columns, found = product_columns(np, product_ids, lines[:, 0].astype(np.int64))
+    lines, columns = lines[found], columns[found]
+    warehouses = np.bincount(columns, minlength=len(product_ids))
+    shipped = np.bincount(columns, weights=lines[:, 3], minlength=len(product_ids))[columns]
+    share = np.where(shipped > 0, lines[:, 3] / np.maximum(shipped, 1), 1 / np.maximum(warehouses[columns], 1))
+    warehouse_restock = np.maximum(np.ceil(target[columns] * share) - lines[:, 2], 0)
+    product_restock = np.where(warehouses == 0, np.maximum(target - stock, 0), 0)
+
+    recommendations = [(int(product_ids[columns[i]]), names[columns[i]], int(lines[i, 1]), int(lines[i, 2]),
+                        round(float(demand[columns[i]] * share[i]), 2), int(warehouse_restock[i]))
+                       for i in np.flatnonzero(warehouse_restock)]
+    recommendations += [(int(product_ids[i]), names[i], None, int(stock[i]), round(float(demand[i]), 2), int(product_restock[i]))
+                        for i in np.flatnonzero(product_restock)]
+    recommendations.sort(key=lambda row: (-row[5], row[0], row[2] or 0))
+    return recommendations[:limit] if limit else recommendations
+
+def generate_restock_report():
+    try:
+        model = fit_demand_models()
+        recommendations = restock_recommendations()
+        print("Restock Recommendations:")
+        print(f"Demand forecast for the next {RESTOCK_COVER_DAYS} days from sales up to "
+              f"{time.strftime('%Y-%m-%d', time.gmtime(model['last_day'] * 86400))}")
+        if not recommendations:
+            print("Nothing needs restocking.")
+        for product_id, name, warehouse_id, stock, demand, restock in recommendations:
+            where = f"warehouse {warehouse_id}" if warehouse_id is not None else "stock"
+            print(f"Product ID: {product_id}, Name: {name}, {where}: {stock}, Forecast: {demand}, Restock: {restock}")
+    except ImportError as e:
+        print(e)
     except sqlite3.Error as e:
         print("Error:", e)
 
+# HTTP API
+# JSON endpoints over the same functions the menus use. Each handler takes the
+# query arguments and JSON body and returns (status, payload), so the Flask app
+# below (e.g. `gunicorn OSS6:app`) and the asyncio service further down share
+# them. Connections stay per thread and per process (see get_connection).
+MAX_PAGE_SIZE = 500
+
+def encode_page_key(key):
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_page_key(token):
+    # Raises ValueError for anything encode_page_key cannot have produced
+    if not token:
+        return None
+    key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    if not isinstance(key, list) or len(key) != 2:
+        raise ValueError("Invalid page token")
+    return tuple(key)
+
+def page_size_arg(args):
+    return max(1, min(int(args.get('page_size', PAGE_SIZE)), MAX_PAGE_SIZE))
+
+def float_arg(args, name):
+    value = args.get(name)
+    return float(value) if value else None
+
+def product_json(row):
+    product = {"product_id": row[0], "name": row[1], "price": row[2], "stock_quantity": row[3]}
+    if len(row) > 4:
+        product["category"] = row[4]
+    return product
+
+def handle_login(args, body, verified=None):
+    # asgi_app passes verified, having checked the password on the read pool
+    if verified is None:
+        verified = verify_login(body.get('username'), body.get('password'))
+    if verified is None:
+        return 401, {"error": "Invalid username or password"}
+    token = open_session(body.get('username'), *verified)
+    return 200, {"token": token, "user_id": verified[0], "expires_in": SESSION_TTL}
+
+def handle_logout(args, body, token):
+    end_session(token)
+    return 200, {}
+
+def handle_products(args, body):
+    rows, next_key = fetch_products_page(PRODUCTS_QUERY, [], [], args.get('sort', 'product_id'),
+                                         decode_page_key(args.get('after')), page_size_arg(args))
+    return 200, {"products": [product_json(row) for row in rows], "next": encode_page_key(next_key)}
+
+def handle_search_products(args, body):
+    text = args.get('q')
+    category = args.get('category')
+    if text:
+        rows = full_text_search(text, category, float_arg(args, 'min_price'), float_arg(args, 'max_price'), page_size_arg(args))
+        return 200, {"products": [product_json(row) for row in rows], "next": None}
+
+    conditions, params = search_conditions(category, args.get('price_range'), args.get('brand'), float_arg(args, 'min_price'),
+                                           float_arg(args, 'max_price'), int(args['price_bucket']) if args.get('price_bucket') else None)
+    rows, next_key = fetch_products_page(SEARCH_QUERY, conditions, params, args.get('sort', 'product_id'),
+                                         decode_page_key(args.get('after')), page_size_arg(args))
+    return 200, {"products": [product_json(row) for row in rows], "next": encode_page_key(next_key)}
+
+def handle_product_facets(args, body):
+    counts = facet_counts(args.get('category'), args.get('price_range'), args.get('brand'), float_arg(args, 'min_price'),
+                          float_arg(args, 'max_price'), int(args['price_bucket']) if args.get('price_bucket') else None)
+    facets = {facet: [{"value": value, "count": count} for value, count in values]
+              for facet, values in counts["facets"].items()}
+    for entry in facets["price_bucket"]:
+        entry["label"] = price_bucket_label(entry["value"])
+    return 200, {"total": counts["total"], "facets": facets}
+
+def handle_product_details(args, body, product_id):
+    product = get_product(product_id)
+    if product is None:
+        return 404, {"error": "Product not found"}
+    return 200, product_json(product[:4])
+
+def handle_view_cart(args, body, user_id):
+    lines = [{"product_id": product_id, "name": name, "quantity": quantity, "price": price, "total_cost": line_total}
+             for product_id, name, quantity, price, line_total, grand_total in cart_lines(user_id)]
+    # The maintained carts row holds the totals
+    item_count, total_cost = cart_total(user_id)
+    return 200, {"items": lines, "item_count": item_count, "total_cost": total_cost}
+
+def handle_add_to_cart(args, body, user_id):
+    items = body.get('items') or [body]
+    try:
+        items = [(int(item['product_id']), int(item['quantity'])) for item in items]
+    except (KeyError, TypeError):
+        raise ValueError("Each item needs a product_id and a quantity")
+    failed = reserve_items(user_id, items)
+    if failed:
+        return 409, {"error": "Insufficient stock", "failed": failed}
+    return 201, {"reserved": len(items)}
+
+def handle_checkout(args, body, user_id):
+    tracking_id, total_cost, failed = place_order(user_id, body.get('courier_info', ''), body.get('shipping_address', ''))
+    if failed:
+        return 409, {"error": "Products no longer available", "failed": failed}
+    if tracking_id is None:
+        return 400, {"error": "Shopping cart is empty"}
+    return 201, {"tracking_id": tracking_id, "total_cost": total_cost}
+
+def handle_sales_report(args, body):
+    total_sales, total_orders = sales_report()
+    return 200, {"total_sales": total_sales or 0.0, "total_orders": total_orders, "data": report_freshness()}
+
+def handle_popular_products_report(args, body):
+    rows = popular_products_report(int(args.get('limit', 5)))
+    return 200, {"products": [{"name": name, "purchase_count": count} for name, count in rows], "data": report_freshness()}
+
+def handle_restock_report(args, body):
+    try:
+        rows = restock_recommendations(int(args.get('cover_days', RESTOCK_COVER_DAYS)), int(args.get('limit', 0)) or None)
+    except ImportError as e:
+        return 501, {"error": str(e)}
+    return 200, {"restock": [restock_json(row) for row in rows]}
+
+def restock_json(row):
+    product_id, name, warehouse_id, stock, demand, restock = row
+    return {"product_id": product_id, "name": name, "warehouse_id": warehouse_id, "stock": stock,
+            "forecast_demand": demand, "restock_quantity": restock}
+
+# (method, path, handler, writes, auth) -- paths use Flask's converter syntax.
+# auth routes need an "Authorization: Bearer <token>" header from /login; the
+# handler gets the session's user_id (or, for /logout, the token itself).
+ROUTES = [
+    ('POST', '/login', handle_login, True, False),
+    ('POST', '/logout', handle_logout, True, True),
+    ('GET', '/products', handle_products, False, False),
+    ('GET', '/products/search', handle_search_products, False, False),
+    ('GET', '/products/facets', handle_product_facets, False, False),
+    ('GET', '/products/<int:product_id>', handle_product_details, False, False),
+    ('GET', '/cart', handle_view_cart, False, True),
+    ('POST', '/cart', handle_add_to_cart, True, True),
+    ('POST', '/checkout', handle_checkout, True, True),
+    ('GET', '/reports/sales', handle_sales_report, False, False),
+    ('GET', '/reports/popular', handle_popular_products_report, False, False),
+    ('GET', '/reports/restock', handle_restock_report, False, False),
+]
+
+_tables_ready = False
+
+def ensure_tables():
+    global _tables_ready
+    if not _tables_ready:
+        ensure_schema()
+        _tables_ready = True
+
+def bearer_token(authorization):
+    if authorization and authorization.startswith('Bearer '):
+        return authorization[len('Bearer '):].strip()
+    return None
+
+def run_handler(handler, args, body, params, token=None, auth=False):
+    # Runs on a database thread; nothing a failed handler started stays open
+    try:
+        if auth:
+            user_id = session_user(token)
+            if user_id is None:
+                return 401, {"error": "Login required"}
+            params = dict(params, **({"token": token} if handler is handle_logout else {"user_id": user_id}))
+        return handler(args, body, **params)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    except sqlite3.Error as e:
+        return 500, {"error": str(e)}
+    finally:
+        connection = getattr(_local, "connection", None)
+        if connection is not None and connection.in_transaction:
+            connection.rollback()
+
+def flask_view(handler, auth):
+    from flask import request, jsonify
+
+    def view(**params):
+        body = request.get_json(silent=True)
+        status, payload = run_handler(handler, request.args, body if isinstance(body, dict) else {}, params,
+                                      bearer_token(request.headers.get('Authorization')), auth)
+        return jsonify(payload), status
+    view.__name__ = handler.__name__
+    return view
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+def metrics_view():
+    # Query counters for Prometheus; empty unless QUERY_STATS is on
+    return query_metrics_text(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+_app = None
+_app_lock = threading.Lock()
+
+def get_app():
+    # Flask is only imported here, so the CLI and the ASGI service never pay for it
+    global _app
+    with _app_lock:
+        if _app is None:
+            from flask import Flask
+            app = Flask(__name__)
+            app.before_request(ensure_tables)
+            for method, path, handler, writes, auth in ROUTES:
+                app.add_url_rule(path, view_func=flask_view(handler, auth), methods=[method])
+            app.add_url_rule('/metrics', view_func=metrics_view, methods=["GET"])
+            _app = app
+    return _app
+
+def __getattr__(name):
+    # OSS6.app (e.g. `gunicorn OSS6:app`) builds the Flask app on first access
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Asyncio service
+# An ASGI application (e.g. `uvicorn OSS6:asgi_app`) over the same handlers.
+# Requests are read in full on the event loop, so slow clients never hold a
+# database thread. Reads run on READ_WORKERS threads against the WAL database;
+# writes go through a single writer thread so they never contend for the lock.
+# With WRITE_BATCHING on, write handlers only wait on the group-commit queue,
+# so the write pool is widened to let a whole batch be in flight. With SHARDS
+# set, cart and checkout writes get one writer thread per shard, keyed by the
+# session's user, so writes to different shards run side by side. They still
+# commit their stock reservation on DATABASE first, and those transactions
+# queue on its lock (BUSY_TIMEOUT) rather than on a thread.
+READ_WORKERS = os.cpu_count() or 4
+MAX_PENDING = 256
+_executors = {}
+_pending = None
+
+def get_executor(writes, shard=None):
+    name = "read" if not writes else "write" if shard is None else f"write{shard}"
+    if name not in _executors:
+        if shard is not None:
+            workers = 1
+        elif writes:
+            workers = WRITE_BATCH_SIZE if WRITE_BATCHING else 1
+        else:
+            workers = READ_WORKERS
+        _executors[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"shop-{name}")
+    return _executors[name]
+
+def shutdown_executors():
+    for executor in _executors.values():
+        executor.shutdown(wait=True)
+    _executors.clear()
+    stop_write_batcher()
+    shutdown_report_pool()
+
+async def run_in_db_thread(writes, func, *args, shard=None):
+    # Bounds queued work so a burst cannot pile up unlimited jobs
+    global _pending
+    import asyncio  # only the ASGI service needs it, and its server has it loaded
+    if _pending is None:
+        _pending = asyncio.Semaphore(MAX_PENDING)
+    async with _pending:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(writes, shard), func, *args)
+
+def compile_route(path):
+    pattern = re.sub(r'<int:(\w+)>', r'(?P<\1>[0-9]+)', path)
+    return re.compile(f'^{pattern}$')
+
+ASGI_ROUTES = [(method, compile_route(path), handler, writes, auth) for method, path, handler, writes, auth in ROUTES]
+
+def match_route(method, path):
+    # Returns (handler, writes, auth, params) or None; params are converted like Flask's <int:...>
+    for route_method, pattern, handler, writes, auth in ASGI_ROUTES:
+        match = pattern.match(path)
+        if match and route_method == method:
+            return handler, writes, auth, {name: int(value) for name, value in match.groupdict().items()}
+    return None
+
+async def send_body(send, status, body, content_type):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+async def send_json(send, status, payload):
+    await send_body(send, status, json.dumps(payload).encode(), "application/json")
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await run_in_db_thread(True, ensure_tables)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                shutdown_executors()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+
+    if scope["method"] == "GET" and scope["path"] == "/metrics":
+        await send_body(send, 200, query_metrics_text().encode(), METRICS_CONTENT_TYPE)
+        return
+    route = match_route(scope["method"], scope["path"])
+    if route is None:
+        await send_json(send, 404, {"error": "Not found"})
+        return
+    handler, writes, auth, params = route
+    args = dict(parse_qsl(scope.get("query_string", b"").decode()))
+    headers = dict(scope.get("headers", []))
+    token = bearer_token(headers.get(b"authorization", b"").decode())
+    try:
+        body = json.loads(b"".join(chunks) or b"{}")
+    except ValueError:
+        await send_json(send, 400, {"error": "Invalid JSON body"})
+        return
+    if not isinstance(body, dict):
+        body = {}
+
+    if not _tables_ready:
+        await run_in_db_thread(True, ensure_tables)
+    shard = None
+    if handler is handle_login:
+        # The password's key derivation runs on the read pool, so a login storm
+        # never holds the writer thread; only the session insert goes there
+        try:
+            verified = await run_in_db_thread(False, verify_login, body.get('username'), body.get('password'))
+        except sqlite3.Error as e:
+            await send_json(send, 500, {"error": str(e)})
+            return
+        if verified is None:
+            await send_json(send, 401, {"error": "Invalid username or password"})
+            return
+        params = dict(params, verified=verified)
+    if writes and auth and SHARDS > 1 and handler is not handle_logout:
+        # Cart and order writes land on the user's shard; logout only touches sessions
+        user_id = await run_in_db_thread(False, session_user, token)
+        if user_id is None:
+            await send_json(send, 401, {"error": "Login required"})
+            return
+        shard = shard_of(user_id)
+    status, payload = await run_in_db_thread(writes, run_handler, handler, args, body, params, token, auth, shard=shard)
+    await send_json(send, status, payload)
+
 
 def menu(username):
-  print("Menu:")
-  print("1. View Products")
-  print("2. Display and Search products")
-  print("3. Add Product to Cart")
-  print("4. View Cart")
-  print("5. Checkout")
-  print("6. Exit")
-  choice = input("Enter your choice (1-6): ")
-  if choice == '1':
-    view_products()  
-    product_id = input("Enter the product ID to view details: ")
-    view_product_details(product_id,username)
-  elif choice == '2':
-    features()
-  elif choice == '3':
-    user_id = get_user_id(username) 
-    product_id = int(input("Enter the product ID to add to the cart: "))
-    quantity = int(input("Enter the quantity: "))
-    add_to_cart_menu(username,user_id,product_id, quantity)
-  elif choice == '4':
-    user_id = get_user_id(username)  
-    view_shopping_cart(user_id)
-  elif choice == '5':
-    user_id = get_user_id(username) 
-    shipping_address = input("Enter the shipping address: ")
-    checkout(user_id, shipping_address)
-  elif choice == '6':
-        print("Thank you for visiting the Online Shopping system")
-  else:
-        print("Invalid choice. Please try again.")
+  # Loops until the user exits; the actions return here instead of calling menu again
+  while True:
+    print("Menu:")
+    print("1. View Products")
+    print("2. Display and Search products")
+    print("3. Add Product to Cart")
+    print("4. View Cart")
+    print("5. Checkout")
+    print("6. Exit")
+    choice = input("Enter your choice (1-6): ")
+    if choice == '1':
+      view_products()  
+      product_id = input("Enter the product ID to view details: ")
+      view_product_details(product_id,username)
+    elif choice == '2':
+      features()
+    elif choice == '3':
+      product_id = int(input("Enter the product ID to add to the cart: "))
+      quantity = int(input("Enter the quantity: "))
+      add_to_cart_menu(username, product_id, quantity)
+    elif choice == '4':
+      user_id = get_user_id(username)  
+      view_shopping_cart(user_id)
+    elif choice == '5':
+      shipping_address = input("Enter the shipping address: ")
+      checkout(username, shipping_address)
+    elif choice == '6':
+          print("Thank you for visiting the Online Shopping system")
+          return
+    else:
+          print("Invalid choice. Please try again.")
         
     
 
 
 def customer_menu():
+  # Loops until a login hands over to menu(); every other branch comes back here
+  while True:
     print("Customer Menu:")
     print("1. Login")
     print("2. Register")
@@ -587,41 +3299,10 @@ def customer_menu():
         
         if is_existing_user(username, password):
             print("Login successful!")
-            print("Enter your choice")
-            print("1. View Products")
-            print("2. Search products")
-            print("3. Add Product to Cart")
-            print("4. View Cart")
-            print("5. Checkout")
-            print("6. Exit")
-            choice = input("Enter your choice (1-6): ")
-            if choice == '1':
-              view_products()  
-              product_id = input("Enter the product ID to view details: ")
-              view_product_details(product_id,username)
-            elif choice == '2':
-               features()
-            elif choice == '3':
-              user_id = get_user_id(username) 
-              product_id = int(input("Enter the product ID to add to the cart: "))
-              quantity = int(input("Enter the quantity: "))
-              add_to_cart_menu(username,user_id,product_id, quantity)
-              
-            elif choice == '4':
-                user_id = get_user_id(username)  # You need to implement this function
-                view_shopping_cart(user_id)
-            elif choice == '5':
-               user_id = get_user_id(username)  # You need to implement this function
-               shipping_address = input("Enter the shipping address: ")
-               checkout(user_id, shipping_address)
-            elif choice == '6':
-                print("Thank you for visiting the Online Shopping system")
-            else:
-                print("Invalid choice. Please try again.")
-                menu(username)
+            menu(username)
+            return
         else:
             print("No user found")
-            customer_menu()
 
             
     elif choice == '2':
@@ -631,7 +3312,6 @@ def customer_menu():
         email = input("Enter your email: ")
         register_user(username, password, full_name, email)
         print("Please login to view products ")
-        customer_menu()
         
        
     elif choice == '3':
@@ -645,26 +3325,22 @@ def customer_menu():
            new_full_name = input("Enter your new full name: ")
            new_email = input("Enter your new email: ")
            print("PLease log in again with the new login information")
-           user_id= get_user_id(username)
-           update_user_info(user_id, new_full_name, new_email)
-           customer_menu()
+           update_user_info(username, new_full_name, new_email)
         elif choice == '2':
-            username = int(input("Enter your username: "))
+            username = input("Enter your username: ")
             new_password = input("Enter your new password: ")
             print("PLease log in again with the new login information")
-            user_id= get_user_id(username)
-            change_password(user_id, new_password)
-            customer_menu()
+            change_password(username, new_password)
         
         else:
            print("Invalid choice. Exiting.")
-           customer_menu()
     else:
         print("Invalid")
-        customer_menu()
 
 
 def admin_menu():
+  # Runs one admin action; only an invalid choice asks again
+  while True:
     print("Admin Menu:")
     print("1. Inventory Management")
     print("2. Analysis Report")
@@ -690,31 +3366,402 @@ def admin_menu():
         elif choice == '5':
             assign_category_menu()
         elif choice == '6':
-            view.products()
+            view_products()
         elif choice == '7':
             print("Exiting the Online Shopping System.")
         else:
            print("Invalid choice. Please try again.")
+        return
     elif choice == '2':
          print("1.Generate sales report")
          print("Generate Popular products report")
-         choice=int(input("Enter which report you want to generate(1 or 2)"))
+         print("3.Rebuild report data from order history")
+         print("4.Restock recommendations")
+         choice=int(input("Enter which report you want to generate(1, 2, 3 or 4)"))
          if choice == 1:
              generate_sales_report()
          elif choice == 2:
              generate_popular_products_report()
+         elif choice == 3:
+             rebuild_sales_rollups()
+             print("Report data rebuilt successfully!")
+         elif choice == 4:
+             generate_restock_report()
          else:
              print("Invalid choice")
+         return
     else:
         print("Invalid choice.")
-        admin_menu()
 
 
+# Command line
+# `python OSS6.py` with no arguments runs the interactive menus. With a
+# subcommand it runs one operation and prints its result as JSON, e.g.
+#
+#   python OSS6.py search --category Books
+#   python OSS6.py add-to-cart --user alice 12 2
+#   python OSS6.py batch commands.txt
+#
+# batch runs one subcommand per line (blank lines and # comments skipped) in a
+# single process and connection, printing one JSON object per line. Each
+# command function returns (status, payload) like the HTTP handlers, and the
+# exit status is 1 if any command got a status of 400 or more. Anything the
+# shared functions print goes to stderr so stdout stays machine-readable.
+
+def cli_user_id(username):
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT user_id FROM users WHERE username = ?', (username,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(f"No such user: {username}")
+    return row[0]
+
+def cli_fields(text, count, name):
+    # Splits "a:b[:c]" arguments into count integers
+    try:
+        values = [int(value) for value in text.split(':')]
+    except ValueError:
+        values = []
+    if len(values) != count:
+        raise ValueError(f"Invalid {name}: {text}")
+    return values
+
+def cli_query_args(options, *names):
+    # The HTTP handlers take query arguments as a dict of strings
+    args = {}
+    for name in names:
+        value = getattr(options, name)
+        if value is not None:
+            args[name] = str(value)
+    return args
+
+def cli_init(options):
+    create_tables()
+    for shard in range(SHARDS if SHARDS > 1 else 0):
+        get_shard_connection(shard)
+    return 200, {"schema_version": get_schema_version(get_connection().cursor())}
+
+def cli_register(options):
+    try:
+        user_id = create_user(options.username, options.password, options.full_name, options.email)
+    except sqlite3.IntegrityError:
+        return 409, {"error": "Username or email already exists."}
+    return 201, {"user_id": user_id}
+
+def cli_login(options):
+    return handle_login({}, {"username": options.username, "password": options.password})
+
+def cli_update_user(options):
+    cli_user_id(options.user)
+    update_user_info(options.user, options.full_name, options.email)
+    return 200, {}
+
+def cli_change_password(options):
+    cli_user_id(options.user)
+    change_password(options.user, options.password)
+    return 200, {}
+
+def cli_products(options):
+    return handle_products(cli_query_args(options, 'sort', 'after', 'page_size'), {})
+
+def cli_search(options):
+    return handle_search_products(cli_query_args(options, 'q', 'category', 'price_range', 'brand', 'min_price',
+                                                 'max_price', 'price_bucket', 'sort', 'after', 'page_size'), {})
+
+def cli_facets(options):
+    return handle_product_facets(cli_query_args(options, 'category', 'price_range', 'brand', 'min_price', 'max_price',
+                                                'price_bucket'), {})
+
+def cli_product(options):
+    return handle_product_details({}, {}, options.product_id)
+
+def cli_cart(options):
+    return handle_view_cart({}, {}, cli_user_id(options.user))
+
+def cli_add_to_cart(options):
+    items = [(options.product_id, options.quantity)]
+    failed = reserve_items(cli_user_id(options.user), items, options.warehouse)
+    if failed:
+        return 409, {"error": "Insufficient stock", "failed": failed}
+    return 201, {"reserved": len(items)}
+
+def cli_checkout(options):
+    items = [tuple(cli_fields(item, 2, "item")) for item in options.item] or None
+    tracking_id, total_cost, failed = place_order(cli_user_id(options.user), options.courier, options.address,
+                                                  items, options.warehouse)
+    if failed:
+        return 409, {"error": "Products no longer available", "failed": failed}
+    if tracking_id is None:
+        return 400, {"error": "Shopping cart is empty"}
+    return 201, {"tracking_id": tracking_id, "total_cost": total_cost}
+
+def cli_order(options):
+    receipt = order_receipt(options.tracking_id)
+    if receipt is None:
+        return 404, {"error": "Order not found"}
+    return 200, {"tracking_id": options.tracking_id, "receipt": receipt}
+
+def cli_add_product(options):
+    product_id = run_write(write_add_product, options.name, options.price, options.stock, options.category)
+    return 201, {"product_id": product_id}
+
+def cli_delete_product(options):
+    if not run_write(write_delete_product, options.product_id):
+        return 404, {"error": "Product not found"}
+    return 200, {}
+
+def cli_update_product(options):
+    if not run_write(write_update_product, options.product_id, options.name, options.price, options.stock, options.category):
+        return 404, {"error": "Product not found"}
+    revalue_sharded_carts([options.product_id])
+    return 200, {}
+
+def cli_update_stock(options):
+    if not run_write(write_update_stock, options.product_id, options.quantity):
+        return 404, {"error": "No such product, or its stock is kept per warehouse"}
+    return 200, {}
+
+def cli_assign_category(options):
+    if not run_write(write_assign_category, options.product_id, options.category_id):
+        return 404, {"error": "Product not found"}
+    return 200, {}
+
+def cli_adjust_stock(options):
+    failed = adjust_warehouse_stock([tuple(cli_fields(line, 3, "adjustment")) for line in options.adjustment])
+    if failed:
+        return 409, {"error": "Adjustments would make stock negative", "failed": failed}
+    return 200, {"applied": len(options.adjustment)}
+
+def cli_warehouse_stock(options):
+    rows = warehouse_stock(options.product_id)
+    return 200, {"warehouses": [{"warehouse_id": warehouse_id, "quantity": quantity} for warehouse_id, quantity in rows]}
+
+def cli_import(options):
+    report = import_records(options.entity, options.path, options.format, options.rebuild_indexes, options.reject_path)
+    return 200, report
+
+def cli_export(options):
+    return 200, {"exported": export_records(options.entity, options.path, options.format)}
+
+def cli_sales_report(options):
+    return handle_sales_report({}, {})
+
+def cli_popular_report(options):
+    return handle_popular_products_report({"limit": options.limit}, {})
+
+def cli_hourly_report(options):
+    rows = hourly_sales_report(options.product_id, options.start_hour, options.end_hour)
+    return 200, {"hours": [{"hour": hour, "purchase_count": count, "quantity": quantity, "revenue": revenue}
+                           for hour, count, quantity, revenue in rows], "data": report_freshness()}
+
+def cli_refresh_snapshot(options):
+    while True:
+        taken_at = refresh_snapshot()
+        if not options.every:
+            return 200, {"path": snapshot_path(), "taken_at": taken_at}
+        time.sleep(options.every)
+
+def cli_forecast(options):
+    try:
+        model = fit_demand_models(full=options.full)
+        rows = restock_recommendations(options.cover_days, options.limit)
+    except ImportError as e:
+        return 501, {"error": str(e)}
+    return 200, {"model": model, "restock": [restock_json(row) for row in rows]}
 
+def cli_rebuild_reports(options):
+    rebuild_sales_rollups()
+    return 200, {}
 
+def cli_stats(options):
+    return 200, {"cache": cache_stats(), "queries": query_stats(options.limit), "startup": STARTUP}
 
-def main():
-    create_tables()
+def cli_check_plans(options):
+    try:
+        check_query_plans()
+    except RuntimeError as e:
+        return 500, {"error": str(e)}
+    return 200, {}
+
+def build_cli_parser():
+    parser = argparse.ArgumentParser(prog="OSS6.py", description="Online shopping system. Without a command, runs the interactive menus.")
+    parser.add_argument("--db", help=f"database file (default {DATABASE})")
+    parser.add_argument("--query-stats", action="store_true", help="instrument queries for the stats command")
+    parser.add_argument("--shards", type=int, help="keep carts and orders in this many shard files")
+    parser.add_argument("--reporting-snapshot", action="store_true", help="run reports against the reporting snapshot")
+    parser.add_argument("--startup-time", action="store_true", help="report import and schema check times on stderr")
+    commands = parser.add_subparsers(dest="command_name", metavar="command")
+
+    def command(name, function, help):
+        subparser = commands.add_parser(name, help=help, description=help)
+        subparser.set_defaults(command=function)
+        return subparser
+
+    command("init", cli_init, "create or migrate the database")
+    sub = command("register", cli_register, "register a customer")
+    sub.add_argument("--username", required=True)
+    sub.add_argument("--password", required=True)
+    sub.add_argument("--full-name", required=True)
+    sub.add_argument("--email", required=True)
+    sub = command("login", cli_login, "check a password and open a session")
+    sub.add_argument("--username", required=True)
+    sub.add_argument("--password", required=True)
+    sub = command("update-user", cli_update_user, "update a customer's name and email")
+    sub.add_argument("--user", required=True)
+    sub.add_argument("--full-name", required=True)
+    sub.add_argument("--email", required=True)
+    sub = command("change-password", cli_change_password, "set a customer's password")
+    sub.add_argument("--user", required=True)
+    sub.add_argument("--password", required=True)
+
+    sub = command("products", cli_products, "list one page of products")
+    sub.add_argument("--sort", choices=sorted(PRODUCT_SORTS))
+    sub.add_argument("--after", help="the 'next' value of the previous page")
+    sub.add_argument("--page-size", type=int)
+    sub = command("search", cli_search, "search products by filters or full text")
+    sub.add_argument("--q", help="full-text query")
+    sub.add_argument("--category")
+    sub.add_argument("--price-range")
+    sub.add_argument("--brand")
+    sub.add_argument("--min-price", type=float)
+    sub.add_argument("--max-price", type=float)
+    sub.add_argument("--price-bucket", type=int, help=f"0-{len(PRICE_BUCKET_BOUNDS)}, split at {list(PRICE_BUCKET_BOUNDS)}")
+    sub.add_argument("--sort", choices=sorted(PRODUCT_SORTS))
+    sub.add_argument("--after")
+    sub.add_argument("--page-size", type=int)
+    sub = command("facets", cli_facets, "count matching products per category, price bucket, supplier and availability")
+    sub.add_argument("--category")
+    sub.add_argument("--price-range")
+    sub.add_argument("--brand")
+    sub.add_argument("--min-price", type=float)
+    sub.add_argument("--max-price", type=float)
+    sub.add_argument("--price-bucket", type=int)
+    sub = command("product", cli_product, "show one product")
+    sub.add_argument("product_id", type=int)
+
+    sub = command("cart", cli_cart, "show a customer's cart")
+    sub.add_argument("--user", required=True)
+    sub = command("add-to-cart", cli_add_to_cart, "reserve stock into a customer's cart")
+    sub.add_argument("--user", required=True)
+    sub.add_argument("product_id", type=int)
+    sub.add_argument("quantity", type=int)
+    sub.add_argument("--warehouse", type=int, action="append", help="preferred warehouse, nearest first (repeatable)")
+    sub = command("checkout", cli_checkout, "order a customer's cart, or the given items")
+    sub.add_argument("--user", required=True)
+    sub.add_argument("--address", required=True)
+    sub.add_argument("--courier", default="")
+    sub.add_argument("--item", action="append", default=[], metavar="PRODUCT_ID:QUANTITY",
+                     help="order these items instead of the cart (repeatable)")
+    sub.add_argument("--warehouse", type=int, action="append", help="preferred warehouse, nearest first (repeatable)")
+    sub = command("order", cli_order, "show the receipt of an order")
+    sub.add_argument("tracking_id")
+
+    for name, function, help in (("add-product", cli_add_product, "add a product"),
+                                 ("update-product", cli_update_product, "replace a product's details")):
+        sub = command(name, function, help)
+        if function is cli_update_product:
+            sub.add_argument("product_id", type=int)
+        sub.add_argument("--name", required=True)
+        sub.add_argument("--price", type=float, required=True)
+        sub.add_argument("--stock", type=int, required=True)
+        sub.add_argument("--category", type=int, required=True)
+    sub = command("delete-product", cli_delete_product, "delete a product")
+    sub.add_argument("product_id", type=int)
+    sub = command("update-stock", cli_update_stock, "set the stock of a product without warehouse stock")
+    sub.add_argument("product_id", type=int)
+    sub.add_argument("quantity", type=int)
+    sub = command("assign-category", cli_assign_category, "move a product to a category")
+    sub.add_argument("product_id", type=int)
+    sub.add_argument("category_id", type=int)
+    sub = command("adjust-stock", cli_adjust_stock, "add or remove stock per warehouse")
+    sub.add_argument("adjustment", nargs="+", metavar="PRODUCT_ID:WAREHOUSE_ID:DELTA")
+    sub = command("warehouse-stock", cli_warehouse_stock, "show a product's stock per warehouse")
+    sub.add_argument("product_id", type=int)
+    sub = command("import", cli_import, "bulk load a CSV or JSONL file")
+    sub.add_argument("entity", choices=sorted(BULK_ENTITIES))
+    sub.add_argument("path")
+    sub.add_argument("--format", choices=["csv", "jsonl"])
+    sub.add_argument("--rebuild-indexes", action="store_true")
+    sub.add_argument("--reject-path")
+    sub = command("export", cli_export, "dump a table to CSV or JSONL")
+    sub.add_argument("entity", choices=sorted(BULK_ENTITIES))
+    sub.add_argument("path")
+    sub.add_argument("--format", choices=["csv", "jsonl"])
+
+    command("sales-report", cli_sales_report, "total sales and orders")
+    sub = command("popular-report", cli_popular_report, "most purchased products")
+    sub.add_argument("--limit", type=int, default=5)
+    sub = command("hourly-report", cli_hourly_report, "hourly sales of a product")
+    sub.add_argument("product_id", type=int)
+    sub.add_argument("--start-hour", type=int, default=0)
+    sub.add_argument("--end-hour", type=int)
+    command("rebuild-reports", cli_rebuild_reports, "rebuild the report rollups from the orders")
+    sub = command("forecast", cli_forecast, "refit the demand models and recommend restocking")
+    sub.add_argument("--full", action="store_true", help="refit over the whole window instead of the new days")
+    sub.add_argument("--cover-days", type=int, default=RESTOCK_COVER_DAYS, help="days of demand stock should cover")
+    sub.add_argument("--limit", type=int)
+    sub = command("refresh-snapshot", cli_refresh_snapshot, "copy the database to the reporting snapshot")
+    sub.add_argument("--every", type=float, metavar="SECONDS", help="keep refreshing at this interval")
+    sub = command("stats", cli_stats, "cache and query counters of this process")
+    sub.add_argument("--limit", type=int, default=20)
+    command("check-plans", cli_check_plans, "fail if a hot query scans a table")
+
+    sub = commands.add_parser("batch", help="run commands from a file, one per line ('-' for stdin)")
+    sub.add_argument("path")
+    sub.add_argument("--stop-on-error", action="store_true")
+    return parser
+
+def run_cli_command(options):
+    # Returns (status, payload); like run_handler, nothing a failed command
+    # started stays open
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            return options.command(options)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    except sqlite3.Error as e:
+        return 500, {"error": str(e)}
+    finally:
+        connection = getattr(_local, "connection", None)
+        if connection is not None and connection.in_transaction:
+            connection.rollback()
+
+def run_batch(parser, path, stop_on_error=False):
+    # Returns the number of commands that failed
+    failures = 0
+    source = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for line_number, line in enumerate(source, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                # --help and the like print to stdout, which is for results only
+                with contextlib.redirect_stdout(sys.stderr):
+                    options = parser.parse_args(shlex.split(line))
+            except (SystemExit, ValueError):
+                # argparse has already explained the problem on stderr
+                status, payload = 400, {"error": "Invalid command"}
+            else:
+                if getattr(options, "command", None) is None:
+                    status, payload = 400, {"error": "Expected a command (batches do not nest)"}
+                elif options.db or options.query_stats or options.shards or options.reporting_snapshot or options.startup_time:
+                    # The batch already runs with the options given before "batch"
+                    status, payload = 400, {"error": "Global options go before the batch command, not in its lines"}
+                else:
+                    status, payload = run_cli_command(options)
+            print(json.dumps({"line": line_number, "status": status, "result": payload}), flush=True)
+            if status >= 400:
+                failures += 1
+                if stop_on_error:
+                    break
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    return failures
+
+def run_menus():
+    ensure_schema()
   
     print("Welcome to the Online Shopping System!")
 
@@ -727,11 +3774,30 @@ def main():
     else:
         print("Invalid user type. Exiting")
 
-if __name__ == '__main__':
-    main()
-
-
-
-
-
+def main(argv=None):
+    global DATABASE, REPORTING_SNAPSHOT, SHARDS
+    parser = build_cli_parser()
+    options = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if options.db:
+        DATABASE = options.db
+    set_query_stats(options.query_stats or QUERY_STATS)
+    if options.reporting_snapshot:
+        REPORTING_SNAPSHOT = True
+    if options.shards:
+        SHARDS = options.shards
+    if options.command_name is None:
+        run_menus()
+        return 0
+    ensure_tables()
+    if options.startup_time:
+        print(json.dumps({"startup": STARTUP}), file=sys.stderr)
+    if options.command_name == "batch":
+        return 1 if run_batch(parser, options.path, options.stop_on_error) else 0
+    status, payload = run_cli_command(options)
+    print(json.dumps(payload))
+    return 1 if status >= 400 else 0
+
+STARTUP["import_seconds"] = time.perf_counter() - _import_started
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import OSS6
+
+# Benchmark harness for the shop workload
+# Seeds a SQLite file with synthetic users, categories, products, carts and
+# orders, then drives the functions behind the menus and the HTTP API through
+# non-interactive scenarios on a pool of threads. Results are printed (or
+# written) as JSON so runs before and after a change can be compared, e.g.
+#
+#   python benchmark.py --products 50000 --workers 8 --output before.json
+
+SCENARIOS = ["search_products", "full_text_search", "view_products", "add_to_shopping_cart",
+             "checkout", "generate_popular_products_report", "import_products"]
+WORDS = ["red", "blue", "green", "steel", "wooden", "smart", "classic", "mini", "pro", "eco",
+         "lamp", "chair", "phone", "kettle", "jacket", "shoe", "table", "watch", "bottle", "cable"]
+SEED_BATCH = 10000
+FEED_ROWS = 100
+DAY = 86400
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Seed a synthetic shop database and benchmark OSS6 against it")
+    parser.add_argument("--db", default="benchmark.db", help="SQLite file to seed and benchmark")
+    parser.add_argument("--reuse", action="store_true", help="benchmark an existing --db instead of reseeding it")
+    parser.add_argument("--seed", type=int, default=42, help="random seed, for reproducible data and runs")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--carts", type=int, default=2000, help="cart lines spread over the users (duplicates merge)")
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--order-days", type=int, default=90, help="orders are spread over this many past days")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run (repeatable); all of them by default")
+    parser.add_argument("--iterations", type=int, default=1000, help="operations per scenario")
+    parser.add_argument("--workers", type=int, default=4, help="threads issuing operations concurrently")
+    parser.add_argument("--shards", type=int, default=0, help="keep carts and orders in this many OSS6 shards")
+    parser.add_argument("--write-batching", action="store_true", help="run with OSS6.WRITE_BATCHING on")
+    parser.add_argument("--reporting-snapshot", action="store_true",
+                        help="run the report scenario against OSS6's reporting snapshot")
+    parser.add_argument("--query-stats", type=int, metavar="N", default=0,
+                        help="instrument the queries and report the N most expensive ones")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+# Synthetic data
+def product_name(rng):
+    return f"{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.randrange(1000)}"
+
+def batches(rows, size=SEED_BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def by_order_database(rows):
+    # Groups rows whose first field is a user_id by the connection holding
+    # that user's cart and orders
+    groups = {}
+    for row in rows:
+        groups.setdefault(OSS6.order_connection(row[0]), []).append(row[1:])
+    return groups.items()
+
+def seed_database(args):
+    # Builds the database from scratch; returns how long it took
+    started = time.perf_counter()
+    OSS6.close_connection()
+    paths = [args.db] + [OSS6.shard_path(shard) for shard in range(args.shards if args.shards > 1 else 0)]
+    for path in paths:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    OSS6.create_tables()
+    rng = random.Random(args.seed)
+    connection = OSS6.get_connection()
+    cursor = connection.cursor()
+
+    # One hash for every account: hashing each password would dominate seeding
+    password = OSS6.hash_password("password")
+    for batch in batches((i, f"user{i}", password, f"User {i}", f"user{i}@example.com")
+                         for i in range(1, args.users + 1)):
+        cursor.executemany('INSERT INTO users (user_id, username, password, full_name, email) VALUES (?, ?, ?, ?, ?)', batch)
+    cursor.executemany('INSERT INTO categories (category_id, category_name, price_range) VALUES (?, ?, ?)',
+                       [(i, f"category{i}", rng.choice(["budget", "standard", "premium"]))
+                        for i in range(1, args.categories + 1)])
+    for batch in batches((i, round(rng.uniform(1, 500), 2), product_name(rng), rng.randrange(10**5, 10**6),
+                          rng.randint(1, args.categories))
+                         for i in range(1, args.products + 1)):
+        cursor.executemany('INSERT INTO products (product_id, price, name, stock_quantity, category_id) VALUES (?, ?, ?, ?, ?)', batch)
+    prices = dict(cursor.execute('SELECT product_id, price FROM products'))
+    cart_lines = {(rng.randint(1, args.users), rng.randint(1, args.products)): rng.randint(1, 3) for i in range(args.carts)}
+    connection.commit()
+    for order_database, rows in by_order_database((user_id, user_id, product_id, amount, amount * prices[product_id])
+                                                  for (user_id, product_id), amount in cart_lines.items()):
+        order_database.executemany('INSERT INTO shopping_carts (user_id, product_id, amount, total_cost) VALUES (?, ?, ?, ?)', rows)
+        order_database.commit()
+
+    now = time.time()
+    orders = []
+    items = []
+    for order_id in range(1, args.orders + 1):
+        lines = {rng.randint(1, args.products): rng.randint(1, 3) for i in range(rng.randint(1, 4))}
+        total_cost = sum(quantity * prices[product_id] for product_id, quantity in lines.items())
+        user_id = rng.randint(1, args.users)
+        orders.append((user_id, order_id, OSS6.generate_tracking_id(), user_id, "courier", "address",
+                       total_cost, now - rng.random() * args.order_days * DAY))
+        items.extend((user_id, order_id, product_id, quantity, prices[product_id]) for product_id, quantity in lines.items())
+    for order_database, rows in by_order_database(orders):
+        for batch in batches(rows):
+            order_database.executemany('''
+                INSERT INTO orders (order_id, tracking_id, user_id, courier_info, shipping_address, total_cost, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+        order_database.commit()
+    for order_database, rows in by_order_database(items):
+        for batch in batches(rows):
+            order_database.executemany('INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)', batch)
+        order_database.commit()
+    OSS6.rebuild_sales_rollups()
+    # A shard's ANALYZE must not reach its read-only catalog attachment
+    for order_database in [connection] + [OSS6.get_shard_connection(shard) for shard in range(args.shards if args.shards > 1 else 0)]:
+        order_database.execute('ANALYZE main')
+        order_database.commit()
+    return time.perf_counter() - started
+
+# Scenarios
+# Each takes the worker's Random and the run arguments and performs one
+# operation. Menu functions print and prompt, so each scenario calls the
+# function the menu (and the HTTP handler) is built on.
+def run_search_products(rng, args):
+    list(OSS6.cached_search_products(category=f"category{rng.randint(1, args.categories)}"))
+
+def run_full_text_search(rng, args):
+    OSS6.full_text_search(rng.choice(WORDS))
+
+def run_view_products(rng, args):
+    # One listing page starting at a random point of the catalog
+    OSS6.fetch_products_page(OSS6.PRODUCTS_QUERY, [], [], after=(None, rng.randint(0, args.products)))
+
+def run_add_to_shopping_cart(rng, args):
+    OSS6.reserve_items(rng.randint(1, args.users), [(rng.randint(1, args.products), 1)])
+
+def run_checkout(rng, args):
+    # A fresh one-line cart, then the cart checkout
+    user_id = rng.randint(1, args.users)
+    OSS6.reserve_items(user_id, [(rng.randint(1, args.products), 1)])
+    OSS6.place_order(user_id, "courier", "address")
+
+def run_generate_popular_products_report(rng, args):
+    OSS6.popular_products_report()
+
+def run_import_products(rng, args):
+    # The nightly supplier feed: products that already exist, with new prices.
+    # Re-importing them must upsert cleanly, so any rejected row is an error.
+    first = rng.randint(1, max(1, args.products - FEED_ROWS + 1))
+    path = f"{args.db}.feed{threading.get_ident()}.csv"
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("product_id,name,price\n")
+        for product_id in range(first, min(first + FEED_ROWS, args.products + 1)):
+            f.write(f"{product_id},{product_name(rng)},{round(rng.uniform(1, 500), 2)}\n")
+    try:
+        report = OSS6.import_records("products", path)
+    finally:
+        os.remove(path)
+    if report["rejected"]:
+        raise RuntimeError(f"Feed rows rejected: {report['rejects'][:3]}")
+
+def percentile(ordered, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def run_scenario(name, args):
+    operation = globals()["run_" + name]
+    counter = iter(range(args.iterations))
+    counter_lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def worker(index):
+        rng = random.Random(f"{args.seed}-{name}-{index}")
+        own = []
+        while True:
+            with counter_lock:
+                if next(counter, None) is None:
+                    break
+            started = time.perf_counter()
+            try:
+                operation(rng, args)
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            own.append(time.perf_counter() - started)
+        latencies.extend(own)
+        OSS6.close_connection()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(worker, range(args.workers)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "operations": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "seconds": round(elapsed, 4),
+        "throughput_per_second": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    OSS6.DATABASE = args.db
+    OSS6.WRITE_BATCHING = args.write_batching
+    OSS6.SHARDS = args.shards
+    OSS6.set_query_stats(args.query_stats > 0)
+    OSS6.REPORTING_SNAPSHOT = args.reporting_snapshot
+    report = {"config": vars(args).copy(), "sqlite_version": OSS6.sqlite3.sqlite_version,
+              "python_version": sys.version.split()[0], "seed_seconds": None, "scenarios": {}}
+    if args.reuse and os.path.exists(args.db):
+        OSS6.create_tables()
+    else:
+        report["seed_seconds"] = round(seed_database(args), 3)
+    try:
+        for name in args.scenario or SCENARIOS:
+            # Every scenario starts from a cold read cache
+            OSS6.product_cache.clear()
+            OSS6.search_cache.clear()
+            OSS6.reset_query_stats()
+            report["scenarios"][name] = run_scenario(name, args)
+            if args.query_stats:
+                report["scenarios"][name]["queries"] = OSS6.query_stats(args.query_stats)["queries"]
+    finally:
+        OSS6.stop_write_batcher()
+        OSS6.shutdown_report_pool()
+        OSS6.close_connection()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()